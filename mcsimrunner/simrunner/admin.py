@@ -1,6 +1,14 @@
 from django.contrib import admin
 from models import InstrGroup, Instrument, SimRun
 
+def cancel_simruns(modeladmin, request, queryset):
+    for simrun in queryset:
+        simrun.cancel()
+cancel_simruns.short_description = 'Cancel selected simruns'
+
+class SimRunAdmin(admin.ModelAdmin):
+    actions = [cancel_simruns]
+
 admin.site.register(InstrGroup)
 admin.site.register(Instrument)
-admin.site.register(SimRun)
+admin.site.register(SimRun, SimRunAdmin)
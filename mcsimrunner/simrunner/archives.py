@@ -0,0 +1,102 @@
+'''
+On-demand download archives of simrun output.
+
+Archives are compressed while they are streamed to the client, and are written to a cache file in the data
+folder at the same time, which serves later requests. Nothing is compressed until someone asks for it.
+
+The zip of a monitor of a scan sweep, holding its data file of each scan point, is built in-process on the first
+request and cached likewise.
+'''
+import os
+import tarfile
+import zipfile
+import threading
+
+from mcweb.settings import MCRUN_OUTPUT_DIRNAME
+
+# instrument binaries and generated C sources are left out, they can be rebuilt from the .instr
+TAR_EXCLUDE_EXTS = ('.out', '.c', '.bak', '.tmp')
+TAR_NAME = 'simrun.tar.gz'
+
+class ChunkBuffer():
+    ''' file-like sink that collects written data for a generator to yield, copying it to cachefile '''
+    def __init__(self, cachefile):
+        self.chunks = []
+        self.cachefile = cachefile
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.cachefile.write(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def get_tar_members(data_folder):
+    ''' returns the (path, arcname) of each file and symlink of data_folder that goes into its tarball, sorted '''
+    members = []
+    top = os.path.basename(os.path.normpath(data_folder))
+    for (dirpath, dirnames, filenames) in os.walk(data_folder):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if f.endswith(TAR_EXCLUDE_EXTS) or f.startswith(TAR_NAME):
+                continue
+            path = os.path.join(dirpath, f)
+            members.append((path, os.path.join(top, os.path.relpath(path, data_folder))))
+        # symlinked dirs are not descended into, but added as links
+        for d in dirnames:
+            if os.path.islink(os.path.join(dirpath, d)):
+                path = os.path.join(dirpath, d)
+                members.append((path, os.path.join(top, os.path.relpath(path, data_folder))))
+    return members
+
+def stream_tarball(data_folder, chunk_size=1024 * 1024):
+    '''
+    generator yielding the gzipped tarball of data_folder as it is compressed, which is also saved as
+    data_folder/simrun.tar.gz once complete. An aborted download leaves no cache file.
+    '''
+    cachepath = os.path.join(data_folder, TAR_NAME)
+    tmppath = '%s.%d.%d.tmp' % (cachepath, os.getpid(), threading.current_thread().ident)
+    cachefile = open(tmppath, 'wb')
+    complete = False
+    try:
+        buf = ChunkBuffer(cachefile)
+        tar = tarfile.open(fileobj=buf, mode='w|gz')
+        for (path, arcname) in get_tar_members(data_folder):
+            tar.add(path, arcname=arcname, recursive=False)
+            if sum(len(c) for c in buf.chunks) >= chunk_size:
+                yield buf.take()
+        tar.close()
+        yield buf.take()
+        complete = True
+    finally:
+        cachefile.close()
+        if complete:
+            os.rename(tmppath, cachepath)
+        else:
+            os.remove(tmppath)
+
+def get_sweep_zip(data_folder, datafile, scanpoints):
+    '''
+    returns the path of the zip of the monitor file datafile of each scan point of the sweep output in data_folder,
+    as mcstas/<index>/<datafile>, building it if needed
+    '''
+    zippath = os.path.join(data_folder, '%s.zip' % os.path.splitext(datafile)[0])
+    if os.path.isfile(zippath):
+        return zippath
+    tmppath = '%s.%d.%d.tmp' % (zippath, os.getpid(), threading.current_thread().ident)
+    try:
+        with zipfile.ZipFile(tmppath, 'w', zipfile.ZIP_DEFLATED) as z:
+            for i in range(scanpoints):
+                arcname = os.path.join(MCRUN_OUTPUT_DIRNAME, str(i), datafile)
+                if os.path.isfile(os.path.join(data_folder, arcname)):
+                    z.write(os.path.join(data_folder, arcname), arcname)
+        os.rename(tmppath, zippath)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+    return zippath
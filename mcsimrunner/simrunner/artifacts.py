@@ -0,0 +1,61 @@
+'''
+Content-addressed store of instrument artifacts.
+
+The .instr, .c and .out files of an instrument are stored once per content version in ARTIFACT_DIR, named by
+their sha1, and are read-only there. Simrun data folders hardlink the stored files instead of copying the
+instrument files from the sim folder, so that setting up a run copies no data and spawns no processes.
+'''
+import os
+import errno
+import shutil
+import threading
+
+import mcweb.settings as settings
+from simrunner.resultcache import get_file_hash
+
+def get_artifact_dir():
+    return getattr(settings, 'ARTIFACT_DIR', os.path.join(settings.BASE_DIR, 'artifacts'))
+
+def store_artifact(path):
+    ''' returns the path of the stored copy of the file path, storing it if needed, or None if path does not exist '''
+    digest = get_file_hash(path)
+    if not digest:
+        return None
+    stored = os.path.join(get_artifact_dir(), digest[:2], digest + os.path.splitext(path)[1])
+    if os.path.isfile(stored):
+        return stored
+    try:
+        os.makedirs(os.path.dirname(stored))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # concurrent stores of the same file each write their own tmp file, the renames are atomic
+    tmp = '%s.%d.%d.tmp' % (stored, os.getpid(), threading.current_thread().ident)
+    shutil.copy2(path, tmp)
+    os.chmod(tmp, os.stat(tmp).st_mode & ~0o222)
+    os.rename(tmp, stored)
+    return stored
+
+def link_artifact(path, dst):
+    ''' hardlinks the stored copy of the file path to dst, copying it across filesystems. Returns False if path does not exist. '''
+    stored = store_artifact(path)
+    if not stored:
+        return False
+    try:
+        os.link(stored, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(stored, dst)
+    return True
+
+_datafiles = {}
+def list_datafiles(dirname):
+    ''' returns the names of the files in dirname except .gitignore, memoized by the mtime of dirname '''
+    mtime = os.stat(dirname).st_mtime
+    memo = _datafiles.get(dirname)
+    if memo and memo[0] == mtime:
+        return memo[1]
+    files = [f for f in os.listdir(dirname) if os.path.isfile(os.path.join(dirname, f)) and f != '.gitignore']
+    _datafiles[dirname] = (mtime, files)
+    return files
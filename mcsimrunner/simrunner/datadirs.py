@@ -0,0 +1,73 @@
+'''
+Layout of the simrun data folders in static/data.
+
+Data folders are sharded into DATA_SHARD_LEVELS levels of subdirs, named by the leading hex digit pairs of
+the sha1 of the folder name, e.g. static/data/3f/a2/<user>_<instr>_<timestamp>_<id>, to keep directories small.
+The simrun id makes folder names unique, also for simruns created within the same second.
+Folders of the flat layout are moved into their shard by the shard_data command, which leaves a symlink at
+the old path, so that the URLs of existing result pages keep working.
+'''
+import os
+import hashlib
+
+from simrunner.models import SimRun
+from mcweb.settings import STATIC_URL, DATA_DIRNAME
+import mcweb.settings as settings
+
+def get_data_basedir():
+    return os.path.join(STATIC_URL.lstrip('/'), DATA_DIRNAME)
+
+def get_data_folder(name):
+    ''' returns the sharded data folder path of the folder name '''
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    shards = [digest[2 * i:2 * i + 2] for i in range(getattr(settings, 'DATA_SHARD_LEVELS', 2))]
+    return os.path.join(get_data_basedir(), *(shards + [name]))
+
+def get_simrun_folder(simrun):
+    ''' returns the data folder path of the saved simrun '''
+    return get_data_folder('%s_%d' % (simrun.__str__(), simrun.id))
+
+def rebase_link(target, linkdir, srcroot, dstdir):
+    '''
+    returns the symlink target to use in dstdir for a symlink to target in linkdir, when a tree is moved or copied
+    from srcroot. Relative targets inside the tree are kept, those outside of it are adjusted to the new depth.
+    '''
+    if os.path.isabs(target):
+        return target
+    dest = os.path.normpath(os.path.join(linkdir, target))
+    if not os.path.relpath(dest, srcroot).startswith(os.pardir):
+        return target
+    return os.path.relpath(dest, dstdir)
+
+def shard_folder(simrun):
+    '''
+    moves the data folder of the finished simrun from the flat layout into its shard, leaving a symlink at the
+    old path, and updates the data folders of simrun and its subruns. Returns the new folder.
+    '''
+    old = simrun.data_folder
+    new = get_data_folder(os.path.basename(old))
+    if not os.path.isdir(os.path.dirname(new)):
+        os.makedirs(os.path.dirname(new))
+    os.rename(old, new)
+    os.symlink(os.path.relpath(new, os.path.dirname(old)), old)
+
+    for (dirpath, dirnames, filenames) in os.walk(new):
+        for f in dirnames + filenames:
+            path = os.path.join(dirpath, f)
+            if os.path.islink(path):
+                olddir = os.path.join(old, os.path.relpath(dirpath, new))
+                target = rebase_link(os.readlink(path), olddir, old, dirpath)
+                if target != os.readlink(path):
+                    os.remove(path)
+                    os.symlink(target, path)
+
+    SimRun.objects.filter(id=simrun.id).update(data_folder=new)
+    for s in SimRun.objects.filter(parent=simrun, data_folder__isnull=False).only('data_folder'):
+        SimRun.objects.filter(id=s.id).update(data_folder=new + s.data_folder[len(old):])
+    return new
+
+def remove_legacy_link(folder):
+    ''' removes the symlink left at the flat-layout path of folder by shard_folder, if any '''
+    link = os.path.join(get_data_basedir(), os.path.basename(folder))
+    if link != folder and os.path.islink(link):
+        os.remove(link)
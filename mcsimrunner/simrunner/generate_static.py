@@ -4,7 +4,9 @@
 Generates static html browser pages for simrunner data output.
 Uses django templates to generate the html.
 '''
+import os
 from django.template import Context
+from django.utils import timezone
 from os.path import basename, join, splitext
 from django.template.loader import get_template
 from django.template.loader import render_to_string
@@ -202,7 +204,27 @@ class McStaticDataBrowserGenerator():
 
 
 def write_html(filepath, text):
-    ''' writes file <filepath> with content <text> to disk '''
-    f = open(filepath, 'w')
+    '''
+    writes file <filepath> with content <text> to disk. The file is replaced by a rename, so that a file
+    hardlinked from a cached simrun is never modified in place.
+    '''
+    tmppath = filepath + '.tmp'
+    f = open(tmppath, 'w')
     f.write(text)
     f.close()
+    os.rename(tmppath, filepath)
+
+def write_results(simrun):
+    ''' Generate data browser page. '''
+    lin_log_html = 'lin_log_url: impl.'
+    gen = McStaticDataBrowserGenerator()
+    base_context={'sim_id': simrun.id, 'group_name': simrun.group_name, 'instr_displayname': simrun.instr_displayname,
+                          'date_time_completed': timezone.localtime(simrun.complete).strftime("%H:%M:%S, %d/%m-%Y"),
+                          'params': simrun.params, 'neutrons': simrun.neutrons, 'seed': simrun.seed, 'scanpoints': simrun.scanpoints,
+                          'lin_log_html': lin_log_html,
+                          'data_folder': simrun.data_folder, 'cached': simrun.cache_source_id is not None}
+
+    if simrun.scanpoints == 1:
+        gen.generate_browsepage(base_context, simrun.plot_files, simrun.data_files)
+    else:
+        gen.generate_browsepage_sweep(base_context, simrun.plot_files, simrun.data_files, simrun.scanpoints)
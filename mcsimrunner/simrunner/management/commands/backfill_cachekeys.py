@@ -0,0 +1,36 @@
+'''
+Computes the canonical cache key of existing simruns and indexes the scan points of cachable sweeps,
+which is needed once for simruns created before cache keys were introduced.
+
+Cachable simruns without an instrument hash are assumed to have run against the current instrument
+version and are tagged with its hash. Run disable_cachefrom first for instruments that have changed since.
+'''
+from django.core.management.base import BaseCommand
+from simrunner.models import SimRun
+from simrunner.resultcache import get_simrun_cache_key, get_instr_hash, add_sweep_points
+
+class Command(BaseCommand):
+    help = 'sets the cache key of all simruns and indexes the scan points of cachable sweeps'
+
+    def handle(self, *args, **options):
+        howmany = 0
+        simruns = SimRun.objects.only('group_name', 'instr_displayname', 'params_str', 'gravity', 'scanpoints', 'cache_key')
+        for s in simruns.iterator():
+            key = get_simrun_cache_key(s)
+            if key != s.cache_key:
+                SimRun.objects.filter(id=s.id).update(cache_key=key)
+                howmany = howmany + 1
+        print("updated the cache key of %d simruns" % howmany)
+
+        howmany = 0
+        untagged = SimRun.objects.filter(enable_cachefrom=True, instr_hash=None)
+        for (group_name, instr_displayname) in untagged.values_list('group_name', 'instr_displayname').distinct():
+            instr_hash = get_instr_hash(group_name, instr_displayname)
+            if instr_hash:
+                howmany = howmany + untagged.filter(group_name=group_name, instr_displayname=instr_displayname).update(instr_hash=instr_hash)
+        print("tagged %d cachable simruns with the current instrument hash" % howmany)
+
+        points = 0
+        for s in SimRun.objects.filter(enable_cachefrom=True, scanpoints__gt=1).iterator():
+            points = points + add_sweep_points(s)
+        print("indexed %d scan points of cachable sweeps" % points)
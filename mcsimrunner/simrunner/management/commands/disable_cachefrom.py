@@ -1,5 +1,6 @@
 '''
-When uploading a new version of an already-existing instrument, the simrun cache may need clearing.
+Cached results stop matching automatically when an instrument's source or binary changes, since cache lookups
+require the instrument hash. Use this command to stop cache loading from simruns of an instrument regardless.
 '''
 from django.core.management.base import BaseCommand
 from simrunner.models import SimRun
@@ -12,13 +13,7 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         instrname = options["instrname"][0]
 
-        howmany = 0
-        simruns = SimRun.objects.filter(instr_displayname=instrname)
-        for s in simruns:
-            if s.enable_cachefrom:
-                s.enable_cachefrom = False
-                s.save()
-                howmany = howmany+1
+        howmany = SimRun.objects.filter(instr_displayname=instrname, enable_cachefrom=True).update(enable_cachefrom=False)
 
         print("disabled caching from %d simruns" % howmany)
 
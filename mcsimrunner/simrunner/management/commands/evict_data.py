@@ -0,0 +1,23 @@
+'''
+Deletes the data folders of the least recently used finished simruns until static/data is within a size budget,
+see simrunner.retention. Runworkers do this periodically if RETENTION_INTERVAL_SECS is set.
+'''
+from django.core.management.base import BaseCommand
+import mcweb.settings as settings
+from simrunner.retention import enforce_budget
+
+class Command(BaseCommand):
+    help = 'evicts the data folders of least recently used simruns until static/data is within the retention budget'
+    def add_arguments(self, parser):
+        parser.add_argument('--max-bytes', type=int, default=getattr(settings, 'RETENTION_MAX_BYTES', 0),
+                            help='size budget of static/data (default RETENTION_MAX_BYTES)')
+        parser.add_argument('--keep-days', type=float, default=getattr(settings, 'RETENTION_KEEP_DAYS', 7),
+                            help='keep simruns used within this many days (default RETENTION_KEEP_DAYS)')
+        parser.add_argument('--dry-run', action='store_true', help='only report what would be evicted')
+
+    def handle(self, *args, **options):
+        (evicted, reclaimed, used) = enforce_budget(options['max_bytes'], options['keep_days'],
+                                                    getattr(settings, 'RETENTION_HIT_DAYS', 1), options['dry_run'])
+
+        print("static/data used %.1f MB" % (used / 1e6))
+        print("%s %d simruns, reclaiming %.1f MB" % ('would evict' if options['dry_run'] else 'evicted', evicted, reclaimed / 1e6))
@@ -8,11 +8,17 @@ import subprocess
 import os
 import sys
 import time
-import tarfile
 import threading
 import logging
 import re
 import traceback
+import socket
+import signal
+import resource
+import gzip
+import shutil
+import math
+import random
 
 from django.core.management.base import BaseCommand
 from django.utils import timezone
@@ -20,20 +26,20 @@ from simrunner.models import SimRun
 from mcweb.settings import STATIC_URL, SIM_DIR, DATA_DIRNAME, MCRUN_OUTPUT_DIRNAME, MCPLOT_CMD, MCPLOT_LOGCMD, MCPLOT_USE_HTML_PLOTTER
 from mcweb.settings import MPI_PR_WORKER, MAX_THREADS, MCRUN, BASE_DIR
 import mcweb.settings as settings
-from simrunner.generate_static import McStaticDataBrowserGenerator
+from simrunner.generate_static import write_results
+from simrunner.mcmerge import merge_dirs, write_sweep_summary, relative_error
+from simrunner.resultcache import get_simrun_cache_key, get_instr_hash, get_sweep_params, add_sweep_points, cache_check, find_cached_points, link_tree
+from simrunner.resultcache import find_leader, follow, resolve_followers, resolve_orphans, get_refinement_base
+from simrunner.wakeup import WakeupListener, notify_workers
+from simrunner.retention import enforce_budget, get_data_bytes
+from simrunner.datadirs import get_simrun_folder
+from simrunner.artifacts import link_artifact, list_datafiles
+from simrunner.scheduler import FifoPolicy, get_policy, get_ray_rates, assign_lanes, lane_order, get_lane_slots, get_core_budget
 
 class ExitException(Exception):
     ''' used to signal a runworker shutdown, rather than a simrun object fail-time and -string '''
     pass
 
-def maketar(simrun):
-    ''' makes the tar-file for download from the status page '''
-    try: 
-        with tarfile.open(os.path.join(simrun.data_folder, 'simrun.tar.gz'), "w:gz") as tar:
-            tar.add(simrun.data_folder, arcname=os.path.basename(simrun.data_folder))
-    except:
-        raise Exception('tarfile fail')
-    
 def plot_file(f, log=False):
     cmd = '%s %s' % (MCPLOT_CMD, f)
     if log:
@@ -50,24 +56,6 @@ def plot_file(f, log=False):
             os.rename(f + '.png',os.path.splitext(os.path.splitext(f)[0])[0] + '.png')
     return (stdoutdata, stderrdata)
 
-def sweep_zip_gen(f,dirname):
-    ''' generate monitor zip file in sweep case '''
-    p = os.path.basename(f)
-    p_zip = os.path.splitext(p)[0] + '.zip'
-
-    _log('sweep_zip_gen: %s in %s ' % (p, dirname))
-    
-    cmd = 'find mcstas/ -name ' + p + '| sort -V | xargs zip -r ' + p_zip
-    process = subprocess.Popen(cmd,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-	                       shell=True, cwd=dirname)
-    (stdoutdata, stderrdata) = process.communicate()
-    _log(stdoutdata)
-    _log(stderrdata)
-    return (stdoutdata, stderrdata)
-
-
 def rename_mcstas_to_mccode(simrun):
     ''' run before mcplot to avoid issues with old versions of mcstas '''
     for token in ['.sim', '.dat']:
@@ -83,8 +71,7 @@ def get_monitor_files(mccode_sim):
     return monitor_files
 
 def mcplot(simrun):
-    ''' generates plots from simrun output data '''
-    ''' also spawns monitor zip file creation in case of scan sweep '''
+    ''' generates plots from simrun output data, monitor zip files of scan sweeps are made on request '''
     rename_mcstas_to_mccode(simrun)
     plotfiles_ext = "html" if MCPLOT_USE_HTML_PLOTTER else "png"
 
@@ -126,6 +113,7 @@ def mcplot(simrun):
                 datfiles = map(lambda f: os.path.join(outdir, f), datfiles_nodir)
 
                 for f in datfiles:
+                    check_cancelled(simrun)
                     plot_file(f)
                     plot_file(f, log=True)
 
@@ -145,8 +133,6 @@ def mcplot(simrun):
                         plot_files.append(p)
                         plot_files_log.append(p_log)
                         data_files.append(d)
-            for f in datfiles:
-                sweep_zip_gen(f,simrun.data_folder)
 
         else:
             outdir = os.path.join(simrun.data_folder, MCRUN_OUTPUT_DIRNAME)
@@ -159,6 +145,7 @@ def mcplot(simrun):
             plot_files_log = []
 
             for f in datfiles: 
+                check_cancelled(simrun)
                 plot_file(f)
 
                 p = os.path.basename(f)
@@ -283,20 +270,219 @@ def mcdisplay(simrun, print_mcdisplay_output=False):
     except Exception as e:
         _log('mcdisplay fail: %s \nwith stderr:      %s \n     stderr_wrml: %s' % (e.__str__(), stderrdata, stderrdata2))
     
-def mcrun(simrun, print_mcrun_output=False):
-    ''' runs the simulation associated with simrun '''
+def use_direct_run(simrun, neutrons=None):
+    '''
+    small single-point, single-rank runs skip the mcrun wrapper and execute the compiled instrument binary
+    copied by init_processing, which produces the same output layout
+    '''
+    return simrun.scanpoints == 1 and (simrun.mpi_ranks or MPI_PR_WORKER) == 1 \
+        and (neutrons or simrun.neutrons) <= getattr(settings, 'DIRECT_RUN_MAX_RAYS', 0) \
+        and os.path.isfile(os.path.join(simrun.data_folder, '%s.out' % simrun.instr_displayname))
+
+def limit_resources():
+    ''' Popen preexec_fn: puts the child in a new process group and applies the cpu and memory rlimits (pr. process) '''
+    os.setsid()
+    cpu_secs = getattr(settings, 'SIM_MAX_CPU_SECS', 0)
+    if cpu_secs:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_secs, cpu_secs))
+    memory_mb = getattr(settings, 'SIM_MAX_MEMORY_MB', 0)
+    if memory_mb:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024 * 1024, memory_mb * 1024 * 1024))
+
+def kill_process_group(process, grace_secs=5):
+    ''' terminates the process group of process (shell, mpirun and ranks), killing it if it does not exit in time '''
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        return
+    deadline = time.time() + grace_secs
+    while time.time() < deadline:
+        (pid, status, rusage) = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            process.returncode = -signal.SIGTERM
+            # children that outlive the shell, e.g. backgrounded or ignoring SIGTERM, are not left running
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            return
+        time.sleep(0.2)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    os.wait4(process.pid, 0)
+    process.returncode = -signal.SIGKILL
+
+class ProgressReporter():
+    '''
+    Maintains SimRun.progress for a running simulation. Percent-complete is parsed from the
+    "Trace ETA ... % 10 20 ..." lines of the instrument output and, for scan sweeps, from the number
+    of scan point folders created by mcrun. Without such output, progress is estimated from the
+    expected cpu-seconds of the run, which is based on the instrument's historical ray rate.
+    '''
+    trace_re = re.compile(r'Trace ETA[^%]*%([\d\s]*)$')
+
+    def __init__(self, simrun):
+        self.simrun = simrun
+        self.started = time.time()
+        self.line = ''
+        self.point_percent = None
+        self.last_save = 0
+        self.lock = threading.Lock()
+
+    def feed(self, chunk):
+        ''' called with each chunk of stdout '''
+        with self.lock:
+            lines = (self.line + chunk).split('\n')
+            for l in lines:
+                m = self.trace_re.search(l)
+                if m and m.group(1).split():
+                    self.point_percent = float(m.group(1).split()[-1])
+            # keep the unfinished line, progress numbers are appended to it as the run goes
+            self.line = lines[-1][-1000:]
+        self.update()
+
+    def get_progress(self):
+        elapsed = time.time() - self.started
+        scanpoints = self.simrun.scanpoints
+        percent = None
+        if scanpoints > 1:
+            outdir = os.path.join(self.simrun.data_folder, MCRUN_OUTPUT_DIRNAME)
+            points_started = len([i for i in range(scanpoints) if os.path.isdir(os.path.join(outdir, str(i)))])
+            if points_started > 0:
+                percent = 100.0 * (points_started - 1 + (self.point_percent or 0) / 100.0) / scanpoints
+        elif self.point_percent is not None:
+            percent = self.point_percent
+
+        eta_secs = None
+        if percent:
+            eta_secs = elapsed * (100 - percent) / percent
+        elif self.simrun.expected_cpu_seconds:
+            expected_secs = self.simrun.expected_cpu_seconds / (self.simrun.mpi_ranks or 1)
+            percent = min(99.0, 100.0 * elapsed / expected_secs) if expected_secs > 0 else None
+            eta_secs = max(0, expected_secs - elapsed)
+
+        return {'percent': percent, 'eta_secs': eta_secs, 'time': time.time()}
+
+    def update(self, force=False):
+        ''' saves the progress record, at most every PROGRESS_SAVE_SECS unless forced '''
+        if not force and time.time() - self.last_save < PROGRESS_SAVE_SECS:
+            return
+        self.last_save = time.time()
+        self.simrun.progress = self.get_progress()
+        SimRun.objects.filter(id=self.simrun.id).update(progress_str=self.simrun.progress_str)
+
+def pump_pipe(pipe, filename, max_bytes=0, progress=None):
+    '''
+    copies pipe to filename as output arrives, so that it can be viewed live, dropping anything beyond max_bytes.
+    Every chunk is also fed to the ProgressReporter progress, if given.
+    '''
+    written = 0
+    with open(filename, 'wb') as f:
+        while True:
+            chunk = os.read(pipe.fileno(), 65536)
+            if not chunk:
+                break
+            if progress:
+                progress.feed(chunk)
+            if max_bytes and written + len(chunk) > max_bytes:
+                # keep draining the pipe, the process would block otherwise
+                if written < max_bytes:
+                    f.write(chunk[:max_bytes - written])
+                    f.write('\n[output truncated at %d bytes]\n' % max_bytes)
+                    f.flush()
+                    written = max_bytes
+                continue
+            f.write(chunk)
+            f.flush()
+            written += len(chunk)
+    pipe.close()
+
+def compress_output(filename):
+    ''' replaces filename by filename.gz, if it is larger than SIM_OUTPUT_COMPRESS_MIN_BYTES (0 disables) '''
+    min_bytes = getattr(settings, 'SIM_OUTPUT_COMPRESS_MIN_BYTES', 0)
+    if not min_bytes or not os.path.isfile(filename) or os.path.getsize(filename) < min_bytes:
+        return
+    with open(filename, 'rb') as src:
+        with gzip.open(filename + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    os.remove(filename)
+
+def clear_output(filename):
+    ''' removes filename and its compressed version, if any, left by an earlier batch of the same simrun '''
+    for f in [filename, filename + '.gz']:
+        if os.path.exists(f):
+            os.remove(f)
+
+def check_cancelled(simrun):
+    ''' raises an exception if simrun has been flagged for cancellation, checked between the steps of a run '''
+    if SimRun.objects.filter(id=simrun.id, cancelled__isnull=False).exists():
+        raise Exception('Simulation cancelled.')
+
+def wait_process(simrun, process, progress=None):
+    '''
+    Waits for process, which must have been started with preexec_fn=limit_resources, while enforcing the
+    wall-clock limit and checking for cancellation of simrun, and updating the ProgressReporter progress.
+    Returns the cpu-seconds used by the process and its children, or raises an exception after terminating
+    the process group.
+    '''
+    max_secs = getattr(settings, 'SIM_MAX_WALLTIME_SECS', 0)
+    started = time.time()
+    last_cancel_check = started
+    while True:
+        (pid, status, rusage) = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        now = time.time()
+        if max_secs and now - started > max_secs:
+            kill_process_group(process)
+            raise Exception('Instrument run timed out after %d secs.' % max_secs)
+        if now - last_cancel_check > CANCEL_POLL_SECS:
+            last_cancel_check = now
+            if SimRun.objects.filter(id=simrun.id, cancelled__isnull=False).exists():
+                kill_process_group(process)
+                raise Exception('Instrument run cancelled.')
+        if progress:
+            progress.update()
+        time.sleep(0.2)
+
+    # os.wait4 reaped the process, Popen must not try to
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+        killsig = os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+        # the shell reports a command killed by a signal as exit status 128 + signal
+        killsig = process.returncode - 128
+    if killsig in (signal.SIGXCPU, signal.SIGKILL):
+        raise Exception('Instrument run killed by signal %d (cpu or memory limit exceeded?) - see %s.' % (killsig, simrun.data_folder))
+    return rusage.ru_utime + rusage.ru_stime
+
+def mcrun(simrun, print_mcrun_output=False, neutrons=None, seed=None, outdir=MCRUN_OUTPUT_DIRNAME):
+    ''' runs the simulation associated with simrun, or a batch of neutrons rays of it with seed seed into outdir '''
+    neutrons = neutrons or simrun.neutrons
+    seed = simrun.seed if seed is None else seed
     # assemble the run command
     gravity = '-g ' if simrun.gravity else ''
-    runstr = MCRUN + ' --mpi=' + str(MPI_PR_WORKER) + " " + gravity + simrun.instr_displayname + '.instr -d ' + MCRUN_OUTPUT_DIRNAME
-    runstr = runstr + ' -n ' + str(simrun.neutrons)
+    if use_direct_run(simrun, neutrons):
+        runstr = './' + simrun.instr_displayname + '.out ' + gravity + '-d ' + outdir
+    else:
+        # a single rank runs without mpirun
+        ranks = simrun.mpi_ranks or MPI_PR_WORKER
+        mpi = ' --mpi=' + str(ranks) if ranks > 1 else ''
+        runstr = MCRUN + mpi + " " + gravity + simrun.instr_displayname + '.instr -d ' + outdir
+    runstr = runstr + ' -n ' + str(neutrons)
     if simrun.scanpoints > 1:
         runstr = runstr + ' -N ' + str(simrun.scanpoints)
-    if simrun.seed > 0:
-        runstr = runstr + ' -s ' + str(simrun.seed)
+    if seed > 0:
+        runstr = runstr + ' -s ' + str(seed)
     for p in simrun.params:
         runstr = runstr + ' ' + p[0] + '=' + p[1]
     
     # create empty stdout.txt and stderr.txt files
+    clear_output('%s/stdout.txt' % simrun.data_folder)
+    clear_output('%s/stderr.txt' % simrun.data_folder)
     f = open('%s/stdout.txt' % simrun.data_folder, 'w')
     f.write("no stdout data for: %s" % runstr)
     f.close()
@@ -309,16 +495,25 @@ def mcrun(simrun, print_mcrun_output=False):
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE,
                                shell=True,
-                               cwd=simrun.data_folder)
-    # TODO: implement a timeout (max simulation time)
-    (stdout, stderr) = process.communicate()
-    
-    o = open('%s/stdout.txt' % simrun.data_folder, 'w')
-    o.write(stdout)
-    o.close()
-    e = open('%s/stderr.txt' % simrun.data_folder, 'w')
-    e.write(stderr)
-    e.close()
+                               cwd=simrun.data_folder,
+                               preexec_fn=limit_resources)
+    # stream the pipes to disk in threads, while wait_process enforces limits
+    max_bytes = getattr(settings, 'SIM_OUTPUT_MAX_BYTES', 0)
+    stdout_txt = '%s/stdout.txt' % simrun.data_folder
+    stderr_txt = '%s/stderr.txt' % simrun.data_folder
+    progress = ProgressReporter(simrun)
+    pumps = [threading.Thread(target=pump_pipe, args=(process.stdout, stdout_txt, max_bytes, progress)),
+             threading.Thread(target=pump_pipe, args=(process.stderr, stderr_txt, max_bytes))]
+    for t in pumps:
+        t.setDaemon(True)
+        t.start()
+    try:
+        simrun.cpu_seconds = wait_process(simrun, process, progress)
+    finally:
+        for t in pumps:
+            t.join(5)
+        compress_output(stdout_txt)
+        compress_output(stderr_txt)
     
     if process.returncode != 0:
         raise Exception('Instrument run failure - see %s.' % simrun.data_folder )
@@ -326,35 +521,24 @@ def mcrun(simrun, print_mcrun_output=False):
     _log('data: %s' % simrun.data_folder)
 
 def init_processing(simrun):
-    ''' creates data folder, copies instr files and updates simrun object '''
+    ''' creates data folder, links instr files from the artifact store and updates simrun object '''
     try: 
-        simrun.data_folder = os.path.join(os.path.join(STATIC_URL.lstrip('/'), DATA_DIRNAME), simrun.__str__())
-        os.mkdir(simrun.data_folder)
+        if simrun.parent_id:
+            simrun.data_folder = os.path.join(simrun.parent.data_folder, 'subruns', str(simrun.subrun_index))
+            os.makedirs(simrun.data_folder)
+        else:
+            simrun.data_folder = get_simrun_folder(simrun)
+            os.makedirs(simrun.data_folder)
         simrun.save()
         
-        # copy instrument from sim folder to simrun data folder 
-        instr_source = '%s/%s/%s.instr' % (SIM_DIR, simrun.group_name, simrun.instr_displayname)
-        instr = '%s/%s.instr' % (simrun.data_folder, simrun.instr_displayname)
-        p = subprocess.Popen(['cp','-p',instr_source, instr])
-        p.wait()
-
-        # symlink the .c and the .out files
-        src_c = '%s/%s/%s.c' % (SIM_DIR, simrun.group_name, simrun.instr_displayname)
-        src_out = '%s/%s/%s.out' % (SIM_DIR, simrun.group_name, simrun.instr_displayname)
-        ln_c = '%s/%s.c' % (simrun.data_folder, simrun.instr_displayname)
-        ln_out = '%s/%s.out' % (simrun.data_folder, simrun.instr_displayname)
-        p = subprocess.Popen(['cp','-p',src_c, ln_c])
-        p.wait()
-        p = subprocess.Popen(['cp','-p',src_out, ln_out])
-        p.wait()
+        # hardlink the .instr, .c and .out files of the current instrument version, a missing .c or .out is rebuilt by mcrun
+        for ext in ['.instr', '.c', '.out']:
+            src = '%s/%s/%s%s' % (SIM_DIR, simrun.group_name, simrun.instr_displayname, ext)
+            link_artifact(src, '%s/%s%s' % (simrun.data_folder, simrun.instr_displayname, ext))
 
         # symlink the contents of sim/datafiles/
-        
-        allfiles = [f for f in os.listdir('sim/datafiles/') if os.path.isfile(os.path.join('sim/datafiles/', f))]
-        if '.gitignore' in allfiles:
-            allfiles.remove('.gitignore')
-        for f in allfiles:
-            src = os.path.join('..', '..', '..', 'sim', 'datafiles', f)
+        for f in list_datafiles('sim/datafiles/'):
+            src = os.path.relpath(os.path.join('sim', 'datafiles', f), simrun.data_folder)
             ln = '%s/%s' % (simrun.data_folder, f)
             os.symlink(src, ln)
         
@@ -369,85 +553,318 @@ def check_age(simrun, max_mins):
         raise Exception('Age of object has timed out for %s running %s at time %s).' % 
             (simrun.owner_username,simrun.instr_displayname ,simrun.created.strftime("%H:%M:%S_%Y-%m-%d")))
 
-def get_and_start_new_simrun():
-    ''' gets an unstarted simrun from the db, sets its status to "running" and return it. Otherwise it returns None '''
-    simrun = None
-    simrun_set = SimRun.objects.filter(started=None)
-    if len(simrun_set) > 0:
-        simrun = simrun_set[0]
+# max number of queued simruns considered by the scheduling policy in one go
+QUEUE_WINDOW = 500
 
-        simrun.started = timezone.now()
-        simrun.save()
-        
-    return simrun
+# interval in secs between checks for cancellation of a running simrun
+CANCEL_POLL_SECS = 2
+
+# min interval in secs between saves of the progress of a running simrun
+PROGRESS_SAVE_SECS = 2
 
-def cache_check(simrun):
+_worker_id = None
+def get_worker_id():
+    ''' returns the id of this worker process, used to tag claimed simruns '''
+    global _worker_id
+    if not _worker_id:
+        _worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+    return _worker_id
+
+def claim_simrun(simrun_id, **fields):
     '''
-    Checks if a similar simrun exists and if this run is allows to be loaded from cache.
-    If so, it loads the cache and returns True, and False otherwise.
+    Atomically marks the unstarted simrun with id simrun_id as started by this worker, using a conditional
+    UPDATE, which also sets any additional fields given. Returns the claimed simrun, or None if another
+    worker got there first.
     '''
-    simrun_matches = SimRun.objects.filter(enable_cachefrom=True, group_name=simrun.group_name, instr_displayname=simrun.instr_displayname, params_str=simrun.params_str, gravity=simrun.gravity, scanpoints=simrun.scanpoints, neutrons__gte = simrun.neutrons).order_by('-complete')
-    if len(simrun_matches) > 0:
-        simrun.data_folder = os.path.join(os.path.join(STATIC_URL.lstrip('/'), DATA_DIRNAME), simrun.__str__())
-        # Simple unix cp -r of data directory
-        process = subprocess.Popen("cp -r " + simrun_matches[0].data_folder + " " + simrun.data_folder,
-                                                                  stdout=subprocess.PIPE,
-                                                                  stderr=subprocess.PIPE,
-                                                                  shell=True)
-        (stdout, stderr) = process.communicate()
-        # Run stream editor to replace "Completed" label with "Loaded cache data from"
-        process = subprocess.Popen("sed -i.bak s\"/Completed/Loaded\ cache\ data\ from/\" " + simrun.data_folder + "/browse*.html",
-                                                                                                     stdout=subprocess.PIPE,
-                                                                                                     stderr=subprocess.PIPE,
-                                                                                                     shell=True)
-        (stdout, stderr) = process.communicate()
-        simrun.complete = simrun_matches[0].complete
-        simrun.save()
-        return True
-    else:
-        return False
-
-def write_results(simrun):
-    ''' Generate data browser page. '''
-    lin_log_html = 'lin_log_url: impl.'
-    gen = McStaticDataBrowserGenerator()
-    base_context={'group_name': simrun.group_name, 'instr_displayname': simrun.instr_displayname,
-                          'date_time_completed': timezone.localtime(simrun.complete).strftime("%H:%M:%S, %d/%m-%Y"),
-                          'params': simrun.params, 'neutrons': simrun.neutrons, 'seed': simrun.seed, 'scanpoints': simrun.scanpoints,
-                          'lin_log_html': lin_log_html,
-                          'data_folder': simrun.data_folder}
-
-    if simrun.scanpoints == 1:
-        gen.generate_browsepage(base_context, simrun.plot_files, simrun.data_files)
+    claimed = SimRun.objects.filter(id=simrun_id, started=None).update(started=timezone.now(), worker_id=get_worker_id(), **fields)
+    if claimed == 1:
+        return SimRun.objects.get(id=simrun_id)
+    return None
+
+def get_and_start_new_simrun(policy=None, slots=None):
+    '''
+    gets the unstarted simrun ranked first by the scheduling policy from the db, sets its status to "running"
+    and return it. Only simruns in lanes with an available slot are considered. Returns None if the queue is
+    empty or if nothing in it can be started now.
+    '''
+    if not policy:
+        policy = FifoPolicy()
+
+    # several runworker processes may share the db, retry until we win a claim or the queue is empty
+    while True:
+        candidates = list(SimRun.objects.filter(started=None).order_by('id').values(
+            'id', 'owner_username', 'group_name', 'instr_displayname', 'neutrons', 'scanpoints', 'parent')[:QUEUE_WINDOW])
+        candidates = assign_lanes(policy.order(candidates), get_ray_rates())
+        if slots:
+            candidates = [c for c in candidates if slots.available(c['lane'])]
+        candidates = lane_order(candidates)
+        if len(candidates) == 0:
+            return None
+
+        for c in candidates:
+            simrun = claim_simrun(c['id'], lane=c['lane'], expected_cpu_seconds=c['expected_cpu_seconds'])
+            if simrun:
+                return simrun
+
+def process_results(simrun):
+    ''' generates layout, plots and data browser pages from the mcrun output of simrun, and completes it '''
+    simrun.enable_cachefrom = True
+
+    # cancellation is polled while mcrun runs, and checked between the steps after it
+    check_cancelled(simrun)
+    mcdisplay_webgl(simrun)
+    check_cancelled(simrun)
+    mcdisplay(simrun)
+    check_cancelled(simrun)
+    mcplot(simrun)
+    check_cancelled(simrun)
+
+    # post-processing, the download tarball is made on request
+    simrun.complete = timezone.now()
+    write_results(simrun)
+    if simrun.scanpoints > 1:
+        add_sweep_points(simrun)
+    simrun.data_bytes = get_data_bytes(simrun)
+
+def get_next_batch(done, error, target, first, cap, max_growth):
+    '''
+    returns the number of rays of the next batch of an adaptive simrun, which has run done of at most cap rays
+    reaching the relative error error. Errors scale as 1/sqrt(rays), the estimate is padded by 10% and growth
+    is limited to max_growth times the rays done, as the error of a small batch is itself uncertain.
+    '''
+    needed = done * (error / target) ** 2 * 1.1 if error != float('inf') else max_growth * done
+    return int(min(max(needed - done, first), max_growth * done, cap - done))
+
+def adaptive_mcrun(simrun):
+    '''
+    runs the single-point simrun in batches of increasing size, merging the output after each, until the relative
+    error of simrun.target_monitor (all monitors if blank) is at most simrun.target_error, or simrun.neutrons rays
+    have been run. simrun.neutrons is then set to the rays run.
+    '''
+    cap = simrun.neutrons
+    first = min(cap, int(getattr(settings, 'ADAPTIVE_FIRST_BATCH_RAYS', 100000)))
+    max_growth = getattr(settings, 'ADAPTIVE_MAX_GROWTH', 8)
+    merged = os.path.join(simrun.data_folder, 'merged')
+    rng = random.SystemRandom()
+    (done, cpu_seconds, rays, k) = (0, 0, first, 0)
+    while True:
+        # seeded simruns stay reproducible
+        seed = simrun.seed + k if simrun.seed > 0 else rng.randint(1, 2**31 - 1)
+        batch = 'batch%d' % k
+        mcrun(simrun, neutrons=rays, seed=seed, outdir=batch)
+        cpu_seconds += simrun.cpu_seconds or 0
+        batchdir = os.path.join(simrun.data_folder, batch)
+        if done == 0:
+            os.rename(batchdir, merged)
+        else:
+            merge_dirs([merged, batchdir], merged + '.new')
+            shutil.rmtree(merged)
+            shutil.rmtree(batchdir)
+            os.rename(merged + '.new', merged)
+        done += rays
+
+        error = relative_error(merged, simrun.target_monitor)
+        _log('adaptive: %d rays, relative error %.3g (target %.3g).' % (done, error, simrun.target_error))
+        if error <= simrun.target_error or done >= cap:
+            break
+        rays = get_next_batch(done, error, simrun.target_error, first, cap, max_growth)
+        k += 1
+
+    os.rename(merged, os.path.join(simrun.data_folder, MCRUN_OUTPUT_DIRNAME))
+    simrun.neutrons = done
+    simrun.cpu_seconds = cpu_seconds
+
+def get_chunk_count(simrun, neutrons=None):
+    ''' returns the number of seed-chunks that neutrons (default all) rays of simrun are split into, 1 if they run as a whole '''
+    neutrons = neutrons or simrun.neutrons
+    min_rays = getattr(settings, 'SPLIT_MIN_RAYS', 0)
+    if not min_rays or simrun.parent_id or simrun.scanpoints != 1 or neutrons < min_rays:
+        return 1
+    chunk_rays = getattr(settings, 'SPLIT_CHUNK_RAYS', min_rays)
+    return int(max(1, min(getattr(settings, 'SPLIT_MAX_CHUNKS', 16), math.ceil(neutrons / float(chunk_rays)))))
+
+def queue_subruns(simrun, points):
+    '''
+    queues a single-point subrun of the initialized simrun for each (index, neutrons, seed, params) in points.
+    Subruns are claimed by any worker, like other simruns, and the one finishing last completes simrun.
+    '''
+    subruns = []
+    for (k, neutrons, seed, params) in points:
+        subruns.append(SimRun(owner_username=simrun.owner_username, group_name=simrun.group_name,
+                              instr_displayname=simrun.instr_displayname, neutrons=neutrons, seed=seed,
+                              scanpoints=1, gravity=simrun.gravity, params=params, force_run=True,
+                              parent=simrun, subrun_index=k))
+
+    simrun.subruns_pending = len(subruns)
+    simrun.progress = {'percent': 0, 'eta_secs': None, 'time': time.time()}
+    simrun.save()
+    SimRun.objects.bulk_create(subruns)
+
+def split_simrun(simrun, chunks, neutrons=None):
+    ''' splits neutrons (default all) rays of simrun into chunks seed-chunks, which have distinct seeds '''
+    total = neutrons or simrun.neutrons
+    rng = random.SystemRandom()
+    points = []
+    for k in range(chunks):
+        # seeded simruns stay reproducible
+        seed = simrun.seed + k if simrun.seed > 0 else rng.randint(1, 2**31 - 1)
+        neutrons = total // chunks + (1 if k < total % chunks else 0)
+        points.append((k, neutrons, seed, simrun.params))
+    queue_subruns(simrun, points)
+
+def split_sweep(simrun, cached=None):
+    '''
+    splits the scan sweep simrun into a subrun for each scan point, which run in parallel. Points in cached,
+    {index: output folder}, are copied to the output folder of simrun instead.
+    '''
+    cached = cached or {}
+    outdir = os.path.join(simrun.data_folder, MCRUN_OUTPUT_DIRNAME)
+    for i in cached:
+        link_tree(cached[i], os.path.join(outdir, str(i)))
+    points = enumerate(get_sweep_params(simrun))
+    queue_subruns(simrun, [(i, simrun.neutrons, simrun.seed, params) for (i, params) in points if i not in cached])
+
+def is_sweep(simrun):
+    return simrun.scanpoints > 1 and any(',' in p[1] for p in simrun.params)
+
+def fail_split_simrun(subrun, fail_str):
+    ''' fails the parent of the failed subrun and cancels its other subruns '''
+    now = timezone.now()
+    fail_str = ('subrun %d: %s' % (subrun.subrun_index, fail_str))[:1000]
+    if SimRun.objects.filter(id=subrun.parent_id, failed=None).update(failed=now, fail_str=fail_str) == 1:
+        for s in SimRun.objects.filter(parent_id=subrun.parent_id, complete=None, failed=None):
+            s.cancel()
+
+def finish_split_simrun(simrun):
+    '''
+    assembles the output of the subruns of simrun into its own output folder, as scan point folders and
+    summary for a sweep or by merging seed-chunks, and completes it
+    '''
+    subruns = list(simrun.subruns.order_by('subrun_index'))
+    outdirs = [os.path.join(s.data_folder, MCRUN_OUTPUT_DIRNAME) for s in subruns]
+    outdir = os.path.join(simrun.data_folder, MCRUN_OUTPUT_DIRNAME)
+    if simrun.scanpoints > 1:
+        # scan points loaded from cache are in place already
+        if not os.path.isdir(outdir):
+            os.mkdir(outdir)
+        for (s, d) in zip(subruns, outdirs):
+            os.rename(d, os.path.join(outdir, str(s.subrun_index)))
+        xvars = [p[0] for p in simrun.params if ',' in p[1]]
+        xvalues = [[float(p[1]) for p in params if p[0] in xvars] for params in get_sweep_params(simrun)]
+        write_sweep_summary(outdir, xvars, xvalues, simrun.neutrons, simrun.params)
     else:
-        gen.generate_browsepage_sweep(base_context, simrun.plot_files, simrun.data_files, simrun.scanpoints)
+        # a refined simrun adds the rays of its cached base run
+        base = [os.path.join(simrun.refined_from.data_folder, MCRUN_OUTPUT_DIRNAME)] if simrun.refined_from_id else []
+        merge_dirs(base + outdirs, outdir)
+        # the merged data replaces the chunk data, stdout and stderr of the subruns are kept
+        for d in outdirs:
+            shutil.rmtree(d)
+
+    process_results(simrun)
+    simrun.progress = {'percent': 100, 'eta_secs': 0, 'time': time.time()}
+    simrun.save()
+    resolve_followers(simrun, get_worker_id())
+    _log('assembled %d subruns (%s secs).' % (len(subruns), (simrun.complete - simrun.started).seconds))
+
+def complete_subrun(subrun):
+    '''
+    counts down the pending subruns of the parent of the completed subrun, using conditional updates so that
+    exactly one subrun sees the count reach 0 and finishes the parent
+    '''
+    while True:
+        parent = SimRun.objects.get(id=subrun.parent_id)
+        if parent.failed:
+            return
+        pending = parent.subruns_pending
+        if SimRun.objects.filter(id=parent.id, subruns_pending=pending).update(subruns_pending=pending - 1) == 1:
+            break
+    parent.subruns_pending = pending - 1
+
+    if parent.subruns_pending > 0:
+        chunks = parent.subruns.count()
+        done = chunks - parent.subruns_pending
+        elapsed = (timezone.now() - parent.started).total_seconds()
+        parent.progress = {'percent': 100.0 * done / chunks, 'eta_secs': elapsed * parent.subruns_pending / done, 'time': time.time()}
+        SimRun.objects.filter(id=parent.id).update(progress_str=parent.progress_str)
+        return
+
+    try:
+        finish_split_simrun(parent)
+    except Exception as e:
+        SimRun.objects.filter(id=parent.id, failed=None).update(failed=timezone.now(), fail_str=('merge: %s' % e.__str__())[:1000])
+        _log('merge fail: %s (%s)' % (e.__str__(), type(e).__name__))
+        _log_error(e)
 
-def threadwork(simrun, semaphore):
+def threadwork(simrun, slots=None, budget=None):
     ''' thread method for simulation and plotting '''
     try:
         # check simrun object age
         check_age(simrun, max_mins=3600)
+        simrun.cache_key = get_simrun_cache_key(simrun)
+        simrun.instr_hash = get_instr_hash(simrun.group_name, simrun.instr_displayname)
+
+        # seed-chunks of a split simrun only run the simulation
+        if simrun.parent_id:
+            init_processing(simrun)
+            mcrun(simrun)
+            simrun.complete = timezone.now()
+            simrun.save()
+            _log('subrun %d done (%s secs).' % (simrun.subrun_index, (simrun.complete - simrun.started).seconds))
+            complete_subrun(simrun)
+            return
 
         # check for existing, similar simruns for reuse
         if simrun.force_run or not cache_check(simrun):
+            # an identical simrun in flight completes this one when it finishes
+            leader = None if simrun.force_run else find_leader(simrun)
+            if leader:
+                follow(simrun, leader, get_worker_id())
+                _log('following identical simrun %d.' % leader.id)
+                return
+
             # init processing
             init_processing(simrun)
+
+            # adaptive single-point runs choose their own ray count, and are not refined or split
+            adaptive = simrun.target_error and simrun.scanpoints == 1
+
+            # unseeded runs build on the cached result with the most rays, if any
+            base = None if simrun.force_run or simrun.seed > 0 or adaptive else get_refinement_base(simrun)
+            if base:
+                missing = simrun.neutrons - base.neutrons
+                simrun.refined_from = base
+                split_simrun(simrun, get_chunk_count(simrun, missing), missing)
+                _log('refining simrun %d: %d more rays queued as %d subruns.' % (base.id, missing, simrun.subruns_pending))
+                return
+
+            chunks = 1 if adaptive else get_chunk_count(simrun)
+            if chunks > 1:
+                split_simrun(simrun, chunks)
+                _log('split into %d subruns of about %d rays.' % (chunks, simrun.neutrons // chunks))
+                return
+            if is_sweep(simrun):
+                cached = {} if simrun.force_run else find_cached_points(simrun)
+                if cached or getattr(settings, 'SPLIT_SWEEPS', True):
+                    split_sweep(simrun, cached)
+                    _log('%d scan points loaded from cache, %d queued as subruns.' % (len(cached), simrun.subruns_pending))
+                    if simrun.subruns_pending == 0:
+                        finish_split_simrun(simrun)
+                    return
         
             # process
-            mcrun(simrun)
-            simrun.enable_cachefrom = True
-        
-            mcdisplay_webgl(simrun)
-            mcdisplay(simrun)
-            mcplot(simrun)
-        
-            # post-processing
-            maketar(simrun)
-            simrun.complete = timezone.now()
-            write_results(simrun)
+            if adaptive:
+                adaptive_mcrun(simrun)
+            else:
+                mcrun(simrun)
+            process_results(simrun)
+            if not simrun.cpu_seconds:
+                simrun.cpu_seconds = (simrun.complete - simrun.started).total_seconds() * (simrun.mpi_ranks or MPI_PR_WORKER)
+        else:
+            _log('loaded from cache: %s' % simrun.cache_source.data_folder)
         
         # finish
         simrun.save()
+        resolve_followers(simrun, get_worker_id())
 
         _log('done (%s secs).' % (simrun.complete - simrun.started).seconds)
     
@@ -455,6 +872,10 @@ def threadwork(simrun, semaphore):
         simrun.failed = timezone.now()
         simrun.fail_str = e.__str__()
         simrun.save()
+        if simrun.parent_id:
+            fail_split_simrun(simrun, simrun.fail_str)
+        # followers are requeued
+        resolve_followers(simrun, get_worker_id())
         
         if e is ExitException:
             raise e
@@ -463,34 +884,61 @@ def threadwork(simrun, semaphore):
         _log_error(e)
 
     finally:
-        _log("releasing semaphore")
-        semaphore.release()
+        if slots:
+            _log("releasing %s lane slot and %d cores" % (simrun.lane, simrun.mpi_ranks))
+            slots.release(simrun.lane)
+            budget.release(simrun.mpi_ranks)
+        # simruns held back by the scheduling policy may be startable now
+        notify_workers()
+
+def work(threaded=True, slots=None, budget=None, policy=None):
+    '''
+    iterates non-started SimRun objects, updates statuses, and calls sim, layout display and plot functions.
+    Returns when nothing more can be started, finishing threads wake up the main loop.
+    '''
+    if not policy:
+        policy = FifoPolicy()
+
+    # followers of simruns that failed or were cancelled without requeueing them
+    if resolve_orphans(get_worker_id()) > 0:
+        _log("resolved orphaned followers...")
+
+    while True:
+        if threaded and budget.free() < 1:
+            _log("all cores in use...")
+            return
+
+        # simruns are chosen only when a slot in their lane is available, so that the scheduling policy sees
+        # the queue as it is when the run starts
+        simrun = get_and_start_new_simrun(policy, slots)
+        if not simrun:
+            _log("idle...")
+            return
+
+        # size the mpi rank count from the ray count, the free cores and the number of simruns that could start next
+        if threaded:
+            queue_depth = min(SimRun.objects.filter(started=None).count(), max(0, slots.free() - 1))
+            simrun.mpi_ranks = budget.allocate(simrun.neutrons, queue_depth)
+        else:
+            simrun.mpi_ranks = MPI_PR_WORKER
+        SimRun.objects.filter(id=simrun.id).update(mpi_ranks=simrun.mpi_ranks)
 
-def work(threaded=True, semaphore=None):
-    ''' iterates non-started SimRun objects, updates statuses, and calls sim, layout display and plot functions '''
-    
-    # avoid having two worker threads starting on the same job
-    simrun = get_and_start_new_simrun()
-    
-    while simrun:
         # exceptions raised during the processing block are written to the simrun object as fail, but do not break the processing loop
         try:
             
             if simrun.scanpoints == 1:
-                _log('delegating simrun for %s...' % simrun.instr_displayname)
+                _log('delegating simrun for %s (%s lane, %d ranks)...' % (simrun.instr_displayname, simrun.lane, simrun.mpi_ranks))
             else:
-                _log('delegating simrun for %s (%d-point scansweep)...' % (simrun.instr_displayname, simrun.scanpoints))
+                _log('delegating simrun for %s (%d-point scansweep, %s lane, %d ranks)...' % (simrun.instr_displayname, simrun.scanpoints, simrun.lane, simrun.mpi_ranks))
             
             if threaded:
-                semaphore.acquire() # this will block untill a slot is released
-                t = threading.Thread(target=threadwork, args=(simrun, semaphore))
+                slots.acquire(simrun.lane)
+                t = threading.Thread(target=threadwork, args=(simrun, slots, budget))
                 t.setDaemon(True)
                 t.setName('%s (%s)' % (t.getName().replace('Thread-','T'), simrun.instr_displayname))
                 t.start()
             else:
                 threadwork(simrun)
-            
-            # continue or cause a break iteration
         
         except Exception as e:
             if e is ExitException:
@@ -499,10 +947,18 @@ def work(threaded=True, semaphore=None):
             _log('fail: %s (%s)' % (e.__str__(), type(e).__name__))
             _log_error(e)
 
-        finally:
-            simrun = get_and_start_new_simrun()
-            if not simrun:
-                _log("idle...")
+def retention_loop(interval_secs):
+    ''' thread method enforcing the static/data retention budget every interval_secs '''
+    while True:
+        try:
+            (evicted, reclaimed, used) = enforce_budget(settings.RETENTION_MAX_BYTES, getattr(settings, 'RETENTION_KEEP_DAYS', 7),
+                                                        getattr(settings, 'RETENTION_HIT_DAYS', 1))
+            if evicted > 0:
+                _log('retention: evicted %d simruns, reclaimed %.1f of %.1f MB' % (evicted, reclaimed / 1e6, used / 1e6))
+        except Exception as e:
+            _log('retention fail: %s (%s)' % (e.__str__(), type(e).__name__))
+            _log_error(e)
+        time.sleep(interval_secs)
 
 _wlog = None
 def _log(msg):
@@ -566,20 +1022,38 @@ class Command(BaseCommand):
             raise ExitException('Could not find or create base data folder, exiting (%s).' % data_basedir)            
         
         # global error handling
+        listener = None
         try:
             # debug run
+            policy = get_policy()
+            _log("scheduling policy: %s" % type(policy).__name__)
+
             if options['debug']:
-                work(threaded=False)
+                work(threaded=False, policy=policy)
                 exit()
             
             # main threaded execution loop:
-            sema = threading.BoundedSemaphore(MAX_THREADS)
-            _log("created semaphore with %d slots" % MAX_THREADS)
+            slots = get_lane_slots()
+            _log("created %d slots (%s)" % (MAX_THREADS, slots))
+            budget = get_core_budget()
+            _log("core budget: %s, max %d ranks pr. simrun" % (budget, budget.max_ranks))
             
+            # instrument_post wakes us up through this socket, polling is only a fallback
+            listener = WakeupListener(get_worker_id().replace(':', '_'))
+            poll_secs = getattr(settings, 'WORKER_POLL_SECS', 30)
+            _log("listening for wakeups on %s, polling every %d secs" % (listener.path, poll_secs))
+
+            retention_secs = getattr(settings, 'RETENTION_INTERVAL_SECS', 0)
+            if getattr(settings, 'RETENTION_MAX_BYTES', 0) and retention_secs:
+                t = threading.Thread(target=retention_loop, args=(retention_secs,), name='retention')
+                t.setDaemon(True)
+                t.start()
+                _log("enforcing a static/data budget of %.1f MB every %d secs" % (settings.RETENTION_MAX_BYTES / 1e6, retention_secs))
+
             _log("looking for simruns...")
             while True:
-                work(threaded=True, semaphore=sema)
-                time.sleep(1)
+                work(threaded=True, slots=slots, budget=budget, policy=policy)
+                listener.wait(poll_secs)
             
         # ctr-c exits
         except KeyboardInterrupt:
@@ -599,3 +1073,7 @@ class Command(BaseCommand):
         except Exception as e:
             _log_error(e)
 
+        finally:
+            if listener:
+                listener.close()
+
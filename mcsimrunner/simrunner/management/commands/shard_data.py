@@ -0,0 +1,27 @@
+'''
+Moves the data folders of finished simruns from the flat static/data layout into their shards, see
+simrunner.datadirs. This can run while the site is up, as a symlink is left at each old path.
+'''
+import os
+from django.core.management.base import BaseCommand
+from simrunner.models import SimRun
+from simrunner.datadirs import get_data_basedir, shard_folder
+
+class Command(BaseCommand):
+    help = 'moves the data folders of finished simruns into the sharded static/data layout'
+
+    def handle(self, *args, **options):
+        basedir = os.path.normpath(get_data_basedir())
+        howmany = 0
+        failed = 0
+        simruns = SimRun.objects.filter(parent=None, data_folder__isnull=False).exclude(complete=None, failed=None)
+        for s in simruns.iterator():
+            if os.path.dirname(os.path.normpath(s.data_folder)) != basedir or os.path.islink(s.data_folder) or not os.path.isdir(s.data_folder):
+                continue
+            try:
+                shard_folder(s)
+                howmany = howmany + 1
+            except Exception as e:
+                print("could not move %s: %s" % (s.data_folder, e.__str__()))
+                failed = failed + 1
+        print("moved %d data folders into shards, %d failed" % (howmany, failed))
@@ -0,0 +1,307 @@
+'''
+Statistical merging of McCode (McStas/McXtrace) output folders from runs of the same instrument
+and parameters, but with different seeds and/or ray counts.
+
+Intensities are averaged weighted by the ray count of each run, errors are combined as
+sqrt(sum((w*I_err)^2))/sum(w), and event counts are summed - as done by "mcformat --merge".
+
+Also reads the relative errors that adaptive simruns are stopped on, and assembles the scan sweep summary
+(mccode.dat and mccode.sim) that mcrun -N writes, from point folders 0, 1, ... that were simulated separately.
+'''
+import os
+import re
+import math
+import shutil
+
+def read_lines(filename):
+    f = open(filename)
+    lines = f.read().splitlines()
+    f.close()
+    return lines
+
+def write_lines(filename, lines):
+    f = open(filename, 'w')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+
+def is_numeric_row(line):
+    s = line.strip()
+    if s == '' or s.startswith('#'):
+        return False
+    try:
+        map(float, s.split())
+        return True
+    except ValueError:
+        return False
+
+def fmt(x):
+    return '%.10g' % x
+
+class McCodeData():
+    ''' a monitor .dat file: header/trailer comment lines and blocks of numeric rows '''
+    def __init__(self, filename):
+        self.lines = read_lines(filename)
+        self.blocks = []
+        start = None
+        for i in range(len(self.lines) + 1):
+            numeric = i < len(self.lines) and is_numeric_row(self.lines[i])
+            if numeric and start is None:
+                start = i
+            elif not numeric and start is not None:
+                self.blocks.append((start, i))
+                start = None
+
+    def header(self, key):
+        ''' the value of the first "# key: value" line, or None '''
+        for l in self.lines:
+            m = re.match(r'#\s*%s:\s*(.*)$' % key, l)
+            if m:
+                return m.group(1).strip()
+        return None
+
+    def set_header(self, key, value):
+        for i in range(len(self.lines)):
+            if re.match(r'#\s*%s:' % key, self.lines[i]):
+                self.lines[i] = '# %s: %s' % (key, value)
+
+    def rows(self, b):
+        (first, last) = self.blocks[b]
+        return [map(float, l.split()) for l in self.lines[first:last]]
+
+    def marker(self, b):
+        ''' the comment line just before block b, e.g. "# Errors [PSD/PSD.dat] I_err:" for 2D data '''
+        (first, last) = self.blocks[b]
+        return self.lines[first - 1] if first > 0 else ''
+
+    def ncount(self):
+        return float(self.header('Ncount'))
+
+    def write(self, filename, blocks):
+        ''' writes the file with the numeric rows replaced by blocks, a list of lists of rows '''
+        lines = []
+        prev = 0
+        for b in range(len(self.blocks)):
+            (first, last) = self.blocks[b]
+            lines.extend(self.lines[prev:first])
+            lines.extend([' '.join(map(fmt, r)) for r in blocks[b]])
+            prev = last
+        lines.extend(self.lines[prev:])
+        write_lines(filename, lines)
+
+def merge_values(values, weights):
+    ''' merges "I I_err N" value triplets '''
+    W = float(sum(weights))
+    I = sum(w * v[0] for (v, w) in zip(values, weights)) / W
+    E = math.sqrt(sum((w * v[1]) ** 2 for (v, w) in zip(values, weights))) / W
+    N = sum(v[2] for v in values)
+    return [I, E, N]
+
+def merge_statistics(stats, values, weights):
+    '''
+    Combines "X0=..; dX=..;" style statistics of the runs, weighted by intensity, as the mean and
+    variance of a mixture. Returns None if they can not be parsed.
+    '''
+    try:
+        parsed = [dict((k.strip(), float(v)) for (k, v) in [kv.split('=') for kv in s.split(';') if '=' in kv]) for s in stats]
+    except ValueError:
+        return None
+    w = [wi * v[0] for (v, wi) in zip(values, weights)]
+    W = float(sum(w))
+    if W == 0:
+        return stats[0]
+    out = []
+    for axis in ['X', 'Y', 'Z']:
+        k0 = '%s0' % axis
+        kd = 'd%s' % axis
+        if not all(k0 in p and kd in p for p in parsed):
+            continue
+        mean = sum(wi * p[k0] for (p, wi) in zip(parsed, w)) / W
+        second = sum(wi * (p[kd] ** 2 + p[k0] ** 2) for (p, wi) in zip(parsed, w)) / W
+        out.append('%s=%s; %s=%s;' % (k0, fmt(mean), kd, fmt(math.sqrt(max(0, second - mean ** 2)))))
+    return ' '.join(out) if out else stats[0]
+
+def signal(intensities):
+    if len(intensities) == 0:
+        return None
+    return 'Min=%s; Max=%s; Mean=%s;' % (fmt(min(intensities)), fmt(max(intensities)), fmt(sum(intensities) / len(intensities)))
+
+def merge_dat(filenames, outfile):
+    ''' merges monitor files filenames of the runs into outfile, returns the merged McCodeData '''
+    dats = [McCodeData(f) for f in filenames]
+    first = dats[0]
+    weights = [d.ncount() for d in dats]
+    W = sum(weights)
+
+    if len(first.blocks) == 3 and first.marker(1).lstrip('# ').startswith('Errors'):
+        # 2D: blocks of I, I_err and N
+        (I, E, N) = [[d.rows(b) for d in dats] for b in range(3)]
+        shape = [len(r) for r in I[0]]
+        mI = []
+        mE = []
+        mN = []
+        for i in range(len(shape)):
+            mI.append([sum(w * I[k][i][j] for (k, w) in enumerate(weights)) / W for j in range(shape[i])])
+            mE.append([math.sqrt(sum((w * E[k][i][j]) ** 2 for (k, w) in enumerate(weights))) / W for j in range(shape[i])])
+            mN.append([sum(N[k][i][j] for k in range(len(dats))) for j in range(shape[i])])
+        blocks = [mI, mE, mN]
+        intensities = [x for r in mI for x in r]
+    elif len(first.blocks) == 1 and len((first.header('variables') or '').split()) == 4:
+        # 1D: columns x, I, I_err, N
+        rows = [d.rows(0) for d in dats]
+        merged = []
+        for i in range(len(rows[0])):
+            (x, I, E, N) = (rows[0][i][0], 0, 0, 0)
+            for (k, w) in enumerate(weights):
+                I += w * rows[k][i][1]
+                E += (w * rows[k][i][2]) ** 2
+                N += rows[k][i][3]
+            merged.append([x, I / W, math.sqrt(E) / W, N])
+        blocks = [merged]
+        intensities = [r[1] for r in merged]
+    else:
+        # event lists and other data without errors are concatenated
+        blocks = [[r for d in dats for r in d.rows(b)] for b in range(len(first.blocks))]
+        intensities = []
+
+    values = [map(float, d.header('values').split()) for d in dats if d.header('values')]
+    if len(values) == len(dats):
+        first.set_header('values', ' '.join(map(fmt, merge_values(values, weights))))
+        stats = [d.header('statistics') for d in dats]
+        if all(stats):
+            merged_stats = merge_statistics(stats, values, weights)
+            if merged_stats:
+                first.set_header('statistics', merged_stats)
+    if intensities:
+        first.set_header('signal', signal(intensities))
+    first.set_header('Ncount', fmt(W))
+
+    first.write(outfile, blocks)
+    return first
+
+def read_sim(filename):
+    ''' returns the lines of a mccode.sim file and a list of (begin, end) line indices of its data sections '''
+    lines = read_lines(filename)
+    sections = []
+    begin = None
+    for i in range(len(lines)):
+        s = lines[i].strip()
+        if s == 'begin data':
+            begin = i
+        elif s == 'end data' and begin is not None:
+            sections.append((begin, i))
+            begin = None
+    return (lines, sections)
+
+def sim_value(lines, begin, end, key):
+    for l in lines[begin:end]:
+        s = l.strip()
+        if s.startswith('%s:' % key):
+            return s.split(':', 1)[1].strip()
+    return None
+
+def relative_error(outdir, monitor=None):
+    '''
+    returns the largest relative error I_err/|I| of the integrated intensities in the mccode.sim of outdir, of the
+    monitor matching monitor by component or file name, or of all monitors. Monitors without intensity count as inf.
+    '''
+    (lines, sections) = read_sim(os.path.join(outdir, 'mccode.sim'))
+    errors = []
+    for (begin, end) in sections:
+        if monitor and monitor not in (sim_value(lines, begin, end, 'component'), sim_value(lines, begin, end, 'filename')):
+            continue
+        (I, E) = map(float, sim_value(lines, begin, end, 'values').split()[:2])
+        errors.append(E / abs(I) if I != 0 else float('inf'))
+    if monitor and not errors:
+        raise Exception('no such monitor: %s' % monitor)
+    return max(errors) if errors else float('inf')
+
+def merge_dirs(srcdirs, dstdir):
+    '''
+    Merges the McCode output folders srcdirs into dstdir (which is created), including a regenerated
+    mccode.sim. Monitors without a data file (0D) are merged from their mccode.sim values.
+    '''
+    if not os.path.isdir(dstdir):
+        os.makedirs(dstdir)
+    sims = [read_sim(os.path.join(d, 'mccode.sim')) for d in srcdirs]
+    (lines, sections) = sims[0]
+
+    # the total ray count is stated in the simulation section
+    ncounts = []
+    for (l, s) in sims:
+        n = [x.split(':', 1)[1] for x in l if x.strip().startswith('Ncount:')]
+        ncounts.append(float(n[0]))
+    total = sum(ncounts)
+
+    merged_dats = {}
+    for (begin, end) in sections:
+        filename = sim_value(lines, begin, end, 'filename')
+        if filename:
+            merged_dats[filename] = merge_dat([os.path.join(d, filename) for d in srcdirs], os.path.join(dstdir, filename))
+
+    out = []
+    for i in range(len(lines)):
+        l = lines[i]
+        indent = l[:len(l) - len(l.lstrip())]
+        key = l.strip().split(':', 1)[0]
+        section = [k for k in range(len(sections)) if sections[k][0] < i < sections[k][1]]
+        if key == 'Ncount':
+            l = '%sNcount: %s' % (indent, fmt(total))
+        elif section and key in ('values', 'statistics', 'signal'):
+            (begin, end) = sections[section[0]]
+            filename = sim_value(lines, begin, end, 'filename')
+            if filename and merged_dats[filename].header(key):
+                l = '%s%s: %s' % (indent, key, merged_dats[filename].header(key))
+            elif key == 'values':
+                values = [map(float, sim_value(sl, ss[section[0]][0], ss[section[0]][1], 'values').split()) for (sl, ss) in sims]
+                l = '%svalues: %s' % (indent, ' '.join(map(fmt, merge_values(values, ncounts))))
+        out.append(l)
+    write_lines(os.path.join(dstdir, 'mccode.sim'), out)
+
+    # other files, e.g. the instrument source copied by mcrun, are taken from the first run
+    for f in os.listdir(srcdirs[0]):
+        src = os.path.join(srcdirs[0], f)
+        if f not in merged_dats and f != 'mccode.sim' and os.path.isfile(src):
+            shutil.copy2(src, os.path.join(dstdir, f))
+
+def write_sweep_summary(outdir, xvars, xvalues, ncount, params):
+    '''
+    Writes the mcrun-style scan summary mccode.dat and mccode.sim in outdir, which holds the point folders
+    0, 1, ... xvars are the names of the scanned parameters, xvalues their values at each point, and params
+    the [name, value] pairs of all parameters.
+    '''
+    points = len(xvalues)
+    (lines, sections) = read_sim(os.path.join(outdir, '0', 'mccode.sim'))
+    monitors = [sim_value(lines, begin, end, 'component') for (begin, end) in sections]
+
+    rows = []
+    for i in range(points):
+        (lines, sections) = read_sim(os.path.join(outdir, str(i), 'mccode.sim'))
+        row = list(xvalues[i])
+        for (begin, end) in sections:
+            row.extend(map(float, sim_value(lines, begin, end, 'values').split()[:2]))
+        rows.append(row)
+
+    yvars = ' '.join(['(%s_I,%s_ERR)' % (m, m) for m in monitors])
+    variables = ' '.join(xvars + ['%s_%s' % (m, v) for m in monitors for v in ('I', 'ERR')])
+    xs = [x[0] for x in xvalues]
+    param = ', '.join(['%s = %s' % (p[0], p[1]) for p in params])
+    data = [('type', 'multiarray_1d(%d)' % points),
+            ('title', 'Scan of %s' % ','.join(xvars)),
+            ('xvars', ' '.join(xvars)),
+            ('yvars', yvars),
+            ('xlabel', "'%s'" % ' '.join(xvars)),
+            ('ylabel', "'Intensity'"),
+            ('xlimits', '%s %s' % (fmt(min(xs)), fmt(max(xs)))),
+            ('filename', 'mccode.dat'),
+            ('variables', variables)]
+
+    dat = ['# Ncount: %s' % fmt(ncount), '# Numpoints: %d' % points, '# Param: %s' % param]
+    dat.extend(['# %s: %s' % d for d in data])
+    dat.extend([' '.join(map(fmt, r)) for r in rows])
+    write_lines(os.path.join(outdir, 'mccode.dat'), dat)
+
+    sim = ['begin simulation', 'Ncount: %s' % fmt(ncount), 'Numpoints: %d' % points, 'Param: %s' % param, 'end simulation', '',
+           'begin data']
+    sim.extend(['%s: %s' % d for d in data])
+    sim.append('end data')
+    write_lines(os.path.join(outdir, 'mccode.sim'), sim)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0010_auto_20190903_1410'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='worker_id',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+        migrations.AlterField(
+            model_name='simrun',
+            name='started',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name=b'date started'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0011_simrun_worker_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='cpu_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0012_simrun_cpu_seconds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='expected_cpu_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='simrun',
+            name='lane',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0013_simrun_lane'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='mpi_ranks',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
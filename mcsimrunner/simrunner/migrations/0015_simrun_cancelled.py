@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0014_simrun_mpi_ranks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='cancelled',
+            field=models.DateTimeField(blank=True, null=True, verbose_name=b'date cancelled'),
+        ),
+    ]
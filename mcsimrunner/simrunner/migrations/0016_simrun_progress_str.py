@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0015_simrun_cancelled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='progress_str',
+            field=models.CharField(default=b'{}', max_length=200),
+        ),
+    ]
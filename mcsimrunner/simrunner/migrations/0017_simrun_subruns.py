@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0016_simrun_progress_str'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='subruns', to='simrunner.SimRun'),
+        ),
+        migrations.AddField(
+            model_name='simrun',
+            name='subrun_index',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='simrun',
+            name='subruns_pending',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='simrun',
+            name='neutrons',
+            field=models.BigIntegerField(default=1000000),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0017_simrun_subruns'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SweepPoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('cache_key', models.CharField(db_index=True, max_length=40)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='simrun',
+            name='cache_key',
+            field=models.CharField(blank=True, db_index=True, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='sweeppoint',
+            name='simrun',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sweep_points', to='simrunner.SimRun'),
+        ),
+    ]
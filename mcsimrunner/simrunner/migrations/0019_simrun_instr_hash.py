@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0018_simrun_cache_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='instr_hash',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='simrun',
+            index_together=set([('cache_key', 'instr_hash')]),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0019_simrun_instr_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='cache_source',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='cached_copies', to='simrunner.SimRun'),
+        ),
+    ]
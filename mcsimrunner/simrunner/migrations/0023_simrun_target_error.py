@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0022_simrun_refined_from'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='target_error',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='simrun',
+            name='target_monitor',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simrunner', '0023_simrun_target_error'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simrun',
+            name='cache_hits',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='simrun',
+            name='data_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='simrun',
+            name='evicted',
+            field=models.DateTimeField(blank=True, null=True, verbose_name=b'date evicted'),
+        ),
+        migrations.AddField(
+            model_name='simrun',
+            name='last_access',
+            field=models.DateTimeField(blank=True, null=True, verbose_name=b'date last accessed'),
+        ),
+        migrations.AddField(
+            model_name='simrun',
+            name='pinned',
+            field=models.BooleanField(default=False),
+        ),
+    ]
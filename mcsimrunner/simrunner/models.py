@@ -1,7 +1,7 @@
 '''
 simrunner models
 '''
-from django.db.models import Model, CharField, TextField, ForeignKey, DateTimeField, PositiveIntegerField, BooleanField
+from django.db.models import Model, CharField, TextField, ForeignKey, DateTimeField, PositiveIntegerField, BigIntegerField, BooleanField, FloatField, SET_NULL
 from django.utils import timezone
 import json
 
@@ -45,7 +45,7 @@ class SimRun(Model):
     group_name = CharField(max_length=200, blank=True, null=True)
     instr_displayname = CharField(max_length=200, blank=True, null=True)
     
-    neutrons = PositiveIntegerField(default=1000000)
+    neutrons = BigIntegerField(default=1000000)
     seed = PositiveIntegerField(default=0)
     scanpoints = PositiveIntegerField(default=1)
     gravity = BooleanField(default=False)
@@ -53,18 +53,53 @@ class SimRun(Model):
 
     force_run = BooleanField(default=False)
     enable_cachefrom = BooleanField(default=False)
+    # adaptive mode: rays are added in batches until the relative error of target_monitor (all monitors if blank)
+    # is at most target_error, neutrons being the max. neutrons is set to the rays used on completion.
+    target_error = FloatField(blank=True, null=True)
+    target_monitor = CharField(max_length=200, blank=True, null=True)
+    # canonical sha1 of instrument, params, gravity and scanpoints, see simrunner.resultcache
+    cache_key = CharField(max_length=40, blank=True, null=True, db_index=True)
+    # content hash of the instrument source and binary that the simrun ran against
+    instr_hash = CharField(max_length=40, blank=True, null=True)
+    # the simrun whose results were loaded from cache
+    cache_source = ForeignKey('self', blank=True, null=True, related_name='cached_copies', on_delete=SET_NULL)
+    # an identical simrun in flight, whose result this simrun waits for instead of simulating
+    leader = ForeignKey('self', blank=True, null=True, related_name='followers', on_delete=SET_NULL)
+    # the cached simrun with fewer rays that this simrun adds to, merging the output
+    refined_from = ForeignKey('self', blank=True, null=True, related_name='refinements', on_delete=SET_NULL)
+    # disk retention, see simrunner.retention. Pinned simruns are never evicted.
+    last_access = DateTimeField('date last accessed', blank=True, null=True)
+    cache_hits = PositiveIntegerField(default=0)
+    pinned = BooleanField(default=False)
+    evicted = DateTimeField('date evicted', blank=True, null=True)
+    # disk usage of data_folder when finished, not counting files hardlinked from cache_source
+    data_bytes = BigIntegerField(blank=True, null=True)
 
     # meta-fields below this line
     created = DateTimeField('date created', default=timezone.now)
-    started = DateTimeField('date started', blank=True, null=True)
+    started = DateTimeField('date started', blank=True, null=True, db_index=True)
     complete = DateTimeField('date complete', blank=True, null=True)
     failed = DateTimeField('date failed', blank=True, null=True)
+    cancelled = DateTimeField('date cancelled', blank=True, null=True)
     fail_str = CharField(max_length=1000, blank=True, null=True)
+    worker_id = CharField(max_length=200, blank=True, null=True)
+    cpu_seconds = FloatField(blank=True, null=True)
+    lane = CharField(max_length=20, blank=True, null=True)
+    expected_cpu_seconds = FloatField(blank=True, null=True)
+    mpi_ranks = PositiveIntegerField(blank=True, null=True)
+    # seed-chunks of a large simrun are subruns of it, the parent completes when subruns_pending reaches 0
+    parent = ForeignKey('self', blank=True, null=True, related_name='subruns')
+    subrun_index = PositiveIntegerField(blank=True, null=True)
+    subruns_pending = PositiveIntegerField(default=0)
     
     data_folder = CharField(max_length=200, blank=True, null=True)
     plot_files_str = CharField(max_length=2000, default='[]')
     plot_files_log_str = CharField(max_length=2000, default='[]')
     data_files_str = CharField(max_length=2000, default='[]')
+    progress_str = CharField(max_length=200, default='{}')
+
+    class Meta:
+        index_together = [['cache_key', 'instr_hash']]
     
     @property
     def plot_files(self):
@@ -93,10 +128,37 @@ class SimRun(Model):
     @params.setter
     def params(self, p):
         self.params_str = json.dumps(p)
+    
+    @property
+    def progress(self):
+        return json.loads(self.progress_str)
+    @progress.setter
+    def progress(self, p):
+        self.progress_str = json.dumps(p)
         
+    def cancel(self):
+        ''' cancels a queued simrun right away, or flags a running simrun for termination by its worker '''
+        now = timezone.now()
+        queued = SimRun.objects.filter(id=self.id, started=None)
+        if queued.update(started=now, failed=now, cancelled=now, fail_str='Cancelled before start.') == 0:
+            SimRun.objects.filter(id=self.id, complete=None, failed=None).update(cancelled=now)
+        # a simrun waiting for its subruns or its leader has no process of its own to terminate
+        SimRun.objects.filter(id=self.id, subruns_pending__gt=0, failed=None).update(failed=now, fail_str='Cancelled.')
+        SimRun.objects.filter(id=self.id, leader__isnull=False, complete=None, failed=None).update(failed=now, fail_str='Cancelled.')
+        for subrun in self.subruns.filter(complete=None, failed=None):
+            subrun.cancel()
+        # the parent of a cancelled subrun would wait for it forever, it fails along with its other subruns
+        if self.parent_id:
+            fail_str = 'subrun %d: Cancelled.' % self.subrun_index
+            if SimRun.objects.filter(id=self.parent_id, complete=None, failed=None).update(failed=now, fail_str=fail_str) == 1:
+                for subrun in SimRun.objects.filter(parent_id=self.parent_id, complete=None, failed=None).exclude(id=self.id):
+                    subrun.cancel()
+    
     def status(self):
         if self.complete:
             return 'Complete'
+        elif self.cancelled:
+            return 'Cancelled'
         elif self.failed:
             return 'Error'
         elif self.started:
@@ -106,3 +168,9 @@ class SimRun(Model):
     
     def __str__(self):
         return "%s_%s_%s" % (self.owner_username, self.instr_displayname, str(self.created.strftime("%Y%m%d_%H%M%S")))
+
+class SweepPoint(Model):
+    ''' a scan point of a cachable sweep simrun, keyed as the equivalent single-point simrun '''
+    simrun = ForeignKey(SimRun, related_name='sweep_points')
+    index = PositiveIntegerField()
+    cache_key = CharField(max_length=40, db_index=True)
@@ -0,0 +1,263 @@
+'''
+Result cache lookups for runworker.
+
+Simruns are matched on a canonical cache key: the sha1 of the instrument identity, gravity, scanpoints and
+the params sorted by name, with numeric values normalized, so that e.g. "1", "1.0" and " 1" are equal.
+Scan points of cachable sweeps are indexed individually as SweepPoint objects, keyed as single-point runs.
+
+Identical requests in flight are deduplicated: a new simrun follows an earlier queued or running
+simrun with the same cache key and at least as many rays, and is completed from its result when it
+finishes, or requeued if it fails.
+
+Matches also require the content hash of the instrument source and binary that the cached simrun ran
+against to equal the current one, so that results of an old instrument version stop matching when it is
+replaced, and match again if it is reverted.
+'''
+import os
+import json
+import errno
+import shutil
+import hashlib
+
+from django.utils import timezone
+
+from simrunner.models import SimRun, SweepPoint
+from simrunner.generate_static import write_results
+from simrunner.retention import touch, get_data_bytes
+from simrunner.datadirs import get_simrun_folder, rebase_link
+from mcweb.settings import MCRUN_OUTPUT_DIRNAME, SIM_DIR
+
+def normalize_value(value):
+    ''' canonical form of a param value, which may be a "min,max" scan range '''
+    parts = []
+    for v in str(value).split(','):
+        v = v.strip()
+        try:
+            v = '%.12g' % float(v)
+        except ValueError:
+            pass
+        parts.append(v)
+    return ','.join(parts)
+
+def get_cache_key(group_name, instr_displayname, params, gravity, scanpoints):
+    canonical = json.dumps([group_name, instr_displayname, bool(gravity), int(scanpoints),
+                            sorted([[p[0], normalize_value(p[1])] for p in params])])
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+def get_simrun_cache_key(simrun):
+    return get_cache_key(simrun.group_name, simrun.instr_displayname, simrun.params, simrun.gravity, simrun.scanpoints)
+
+_file_hashes = {}
+def get_file_hash(path):
+    ''' sha1 of the contents of path, memoized by mtime and size, or None if it does not exist '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    memo = _file_hashes.get(path)
+    if memo and memo[0] == (st.st_mtime, st.st_size):
+        return memo[1]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    _file_hashes[path] = ((st.st_mtime, st.st_size), h.hexdigest())
+    return h.hexdigest()
+
+def get_instr_hash(group_name, instr_displayname):
+    ''' content hash of the current .instr and compiled .out of an instrument, None if the .instr is missing '''
+    instr = get_file_hash(os.path.join(SIM_DIR, group_name, '%s.instr' % instr_displayname))
+    if not instr:
+        return None
+    out = get_file_hash(os.path.join(SIM_DIR, group_name, '%s.out' % instr_displayname))
+    return hashlib.sha1(('%s %s' % (instr, out)).encode('utf-8')).hexdigest()
+
+def get_sweep_params(simrun):
+    ''' returns the scalar params of each scan point of simrun, computed from "min,max" values as mcrun -N does '''
+    points = []
+    for i in range(simrun.scanpoints):
+        params = []
+        for (name, value) in simrun.params:
+            if ',' in value:
+                (a, b) = map(float, value.split(','))
+                value = '%.10g' % (a + (b - a) * i / (simrun.scanpoints - 1))
+            params.append([name, value])
+        points.append(params)
+    return points
+
+def add_sweep_points(simrun):
+    ''' (re)indexes the scan points of the completed sweep simrun, returns the number of points '''
+    SweepPoint.objects.filter(simrun=simrun).delete()
+    points = [SweepPoint(simrun=simrun, index=i, cache_key=get_cache_key(simrun.group_name, simrun.instr_displayname, params, simrun.gravity, 1))
+              for (i, params) in enumerate(get_sweep_params(simrun))]
+    SweepPoint.objects.bulk_create(points)
+    return len(points)
+
+def link_tree(src, dst):
+    '''
+    Materializes the folder src as dst using hardlinks, so that no file data is copied. Files are copied
+    only where hardlinks are not possible, e.g. across filesystems. Symlinks are recreated, relative symlinks to
+    outside of src adjusted to the location of dst.
+    Files in dst that are later rewritten must be replaced by a rename, never modified in place.
+    '''
+    os.makedirs(dst)
+    for (dirpath, dirnames, filenames) in os.walk(src):
+        reldir = os.path.relpath(dirpath, src)
+        for d in list(dirnames):
+            if os.path.islink(os.path.join(dirpath, d)):
+                dirnames.remove(d)
+                filenames.append(d)
+            else:
+                os.mkdir(os.path.join(dst, reldir, d))
+        for f in filenames:
+            s = os.path.join(dirpath, f)
+            d = os.path.normpath(os.path.join(dst, reldir, f))
+            if os.path.islink(s):
+                os.symlink(rebase_link(os.readlink(s), dirpath, src, os.path.dirname(d)), d)
+                continue
+            # the download tarball of src has the folder name of src, dst makes its own on request
+            if f.endswith('.bak') or f == 'simrun.tar.gz':
+                continue
+            try:
+                os.link(s, d)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(s, d)
+
+def get_cache_match(simrun):
+    ''' returns the most recent simrun that simrun may be loaded from, or None, using the cache key index '''
+    if not simrun.instr_hash:
+        return None
+    return SimRun.objects.filter(cache_key=simrun.cache_key, instr_hash=simrun.instr_hash, enable_cachefrom=True,
+                                 neutrons__gte=simrun.neutrons).order_by('-complete').first()
+
+def get_refinement_base(simrun):
+    '''
+    returns the cachable single-point simrun with the most rays below those of simrun, which simrun can be
+    refined from by simulating only the difference, or None
+    '''
+    if not simrun.instr_hash or simrun.scanpoints != 1:
+        return None
+    bases = SimRun.objects.filter(cache_key=simrun.cache_key, instr_hash=simrun.instr_hash, enable_cachefrom=True,
+                                  neutrons__lt=simrun.neutrons, data_folder__isnull=False).order_by('-neutrons')
+    for base in bases[:10]:
+        if os.path.isfile(os.path.join(base.data_folder, MCRUN_OUTPUT_DIRNAME, 'mccode.sim')):
+            return base
+    return None
+
+def load_cache(simrun, match):
+    '''
+    loads the results of the cached simrun match into the saved simrun, renders its browse pages and completes it.
+    On failure, the data folder is removed if this call created it, and simrun is not saved.
+    '''
+    folder = get_simrun_folder(simrun)
+    if os.path.exists(folder):
+        raise Exception('data folder exists: %s' % folder)
+    try:
+        link_tree(match.data_folder, folder)
+        simrun.data_folder = folder
+        simrun.cache_source = match
+        simrun.plot_files_str = match.plot_files_str
+        simrun.plot_files_log_str = match.plot_files_log_str
+        simrun.data_files_str = match.data_files_str
+        simrun.complete = match.complete
+        write_results(simrun)
+        simrun.data_bytes = get_data_bytes(simrun)
+        simrun.save()
+    except Exception:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+    touch(match.id, hit=True)
+
+def cache_check(simrun):
+    '''
+    Checks if a similar simrun exists and if this run is allows to be loaded from cache.
+    If so, it loads the cache and returns True, and False otherwise.
+    '''
+    match = get_cache_match(simrun)
+    if match:
+        load_cache(simrun, match)
+        return True
+    else:
+        return False
+
+def find_leader(simrun):
+    '''
+    returns an earlier queued or running simrun that simrun may follow, or None. Leaders always have lower
+    ids than their followers, so that two simruns can never follow each other.
+    '''
+    if not simrun.instr_hash:
+        return None
+    # the rays of adaptive simruns in flight are a max only
+    leaders = SimRun.objects.filter(cache_key=simrun.cache_key, instr_hash=simrun.instr_hash, neutrons__gte=simrun.neutrons,
+                                    complete=None, failed=None, leader=None, parent=None, target_error=None)
+    if simrun.id:
+        leaders = leaders.filter(id__lt=simrun.id)
+    return leaders.order_by('id').first()
+
+def follow(simrun, leader, worker_id):
+    ''' makes the saved, started simrun a follower of leader, resolving it right away if leader has finished meanwhile '''
+    simrun.leader = leader
+    simrun.worker_id = None
+    simrun.save()
+    # either this re-read or the leader's resolve_followers sees the other side's write
+    leader = SimRun.objects.get(id=leader.id)
+    if leader.complete or leader.failed:
+        resolve_follower(simrun, leader, worker_id)
+
+def resolve_follower(follower, leader, worker_id):
+    ''' completes follower from the result of the completed leader, or requeues it if leader failed '''
+    claimed = SimRun.objects.filter(id=follower.id, worker_id=None, complete=None, failed=None).update(worker_id=worker_id)
+    if claimed == 0:
+        return
+    follower = SimRun.objects.get(id=follower.id)
+    if leader.complete and leader.enable_cachefrom and leader.data_folder:
+        try:
+            load_cache(follower, leader)
+        except Exception as e:
+            SimRun.objects.filter(id=follower.id).update(failed=timezone.now(), fail_str=('load from simrun %d: %s' % (leader.id, e.__str__()))[:1000])
+    else:
+        SimRun.objects.filter(id=follower.id).update(leader=None, started=None, worker_id=None)
+
+def resolve_followers(leader, worker_id):
+    ''' resolves the followers of the finished simrun leader '''
+    for f in SimRun.objects.filter(leader=leader, complete=None, failed=None, worker_id=None):
+        resolve_follower(f, leader, worker_id)
+
+def resolve_orphans(worker_id):
+    ''' resolves followers of leaders that finished without resolving them, e.g. cancelled before start '''
+    orphans = SimRun.objects.filter(complete=None, failed=None, worker_id=None, leader__isnull=False)
+    orphans = orphans.exclude(leader__complete=None, leader__failed=None).select_related('leader')
+    for f in orphans:
+        resolve_follower(f, f.leader, worker_id)
+    return len(orphans)
+
+def find_cached_points(simrun):
+    '''
+    Looks up each scan point of the sweep simrun in the results of cachable single-point simruns and in the
+    indexed points of other sweeps. Returns {scan point index: output folder} for the points found.
+    '''
+    if not simrun.instr_hash:
+        return {}
+    indices = {}
+    for (i, params) in enumerate(get_sweep_params(simrun)):
+        key = get_cache_key(simrun.group_name, simrun.instr_displayname, params, simrun.gravity, 1)
+        indices.setdefault(key, []).append(i)
+
+    sources = []
+    singles = SimRun.objects.filter(cache_key__in=indices.keys(), instr_hash=simrun.instr_hash, enable_cachefrom=True,
+                                    neutrons__gte=simrun.neutrons)
+    for s in singles.order_by('-complete').only('cache_key', 'data_folder'):
+        sources.append((s.cache_key, os.path.join(s.data_folder, MCRUN_OUTPUT_DIRNAME)))
+    points = SweepPoint.objects.filter(cache_key__in=indices.keys(), simrun__instr_hash=simrun.instr_hash,
+                                       simrun__enable_cachefrom=True, simrun__neutrons__gte=simrun.neutrons)
+    for p in points.exclude(simrun=simrun).select_related('simrun').order_by('-simrun__complete'):
+        sources.append((p.cache_key, os.path.join(p.simrun.data_folder, MCRUN_OUTPUT_DIRNAME, str(p.index))))
+
+    found = {}
+    for (key, outdir) in sources:
+        if os.path.isfile(os.path.join(outdir, 'mccode.sim')):
+            for i in indices[key]:
+                found.setdefault(i, outdir)
+    return found
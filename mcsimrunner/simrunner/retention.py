@@ -0,0 +1,128 @@
+'''
+Disk retention of simrun data folders in static/data.
+
+The folders of finished simruns are deleted, least recently used first, until the data dir is within a
+size budget. A simrun is used when its results are viewed, and when they are loaded from cache, and each
+cache hit counts as hit_days days of recency, so that popular cached results outlive one-off runs.
+Pinned simruns and simruns used within keep_days are never evicted.
+
+Cached copies hardlink the files of their source (see resultcache.link_tree), so evicting a simrun only
+reclaims the files that no other folder links to.
+
+The disk usage of each data folder is recorded in SimRun.data_bytes when the simrun finishes, and the budget
+is checked against their sum, so that checks do not walk static/data. Files hardlinked from the cache source of
+a simrun are counted with the source, and with one of its cached copies once the source is evicted.
+'''
+import os
+import shutil
+from datetime import timedelta
+
+from django.db.models import F, Sum, Func, FloatField, ExpressionWrapper
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from simrunner.models import SimRun
+from simrunner.datadirs import remove_legacy_link
+
+def get_tree_bytes(path, unique=False, seen=None):
+    '''
+    returns the disk usage of the files in path, counting hardlinked files once. If unique, only files with no
+    links outside of path are counted, i.e. those that deleting path would free.
+    '''
+    seen = seen if seen is not None else {}
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for f in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, f))
+            except OSError:
+                continue
+            key = (st.st_dev, st.st_ino)
+            seen.setdefault(key, [st.st_blocks * 512, st.st_nlink, 0])[2] += 1
+    if unique:
+        return sum(s[0] for s in seen.values() if s[2] >= s[1])
+    return sum(s[0] for s in seen.values())
+
+def touch(simrun_id, hit=False):
+    ''' records a use of the simrun with id simrun_id, a cache hit if hit '''
+    if hit:
+        SimRun.objects.filter(id=simrun_id).update(last_access=timezone.now(), cache_hits=F('cache_hits') + 1)
+    else:
+        SimRun.objects.filter(id=simrun_id).update(last_access=timezone.now())
+
+class DayNumber(Func):
+    ''' a datetime as a number of days, which days can be added to in queries '''
+    template = 'EXTRACT(EPOCH FROM %(expressions)s) / 86400'
+
+    def as_sqlite(self, compiler, connection):
+        return self.as_sql(compiler, connection, template='julianday(%(expressions)s)')
+
+def get_data_bytes(simrun):
+    ''' returns the disk usage of the data folder of simrun, without the files hardlinked from its cache source '''
+    if not os.path.isdir(simrun.data_folder):
+        return 0
+    return get_tree_bytes(simrun.data_folder, unique=simrun.cache_source_id is not None)
+
+def get_used_bytes():
+    ''' returns the disk usage of the data folders of finished simruns, recording it for those finished without '''
+    finished = SimRun.objects.filter(parent=None, data_folder__isnull=False).exclude(complete=None, failed=None)
+    for simrun in finished.filter(data_bytes=None).only('data_folder', 'cache_source').iterator():
+        SimRun.objects.filter(id=simrun.id).update(data_bytes=get_data_bytes(simrun))
+    return finished.aggregate(used=Sum('data_bytes'))['used'] or 0
+
+def get_eviction_candidates(keep_days, hit_days):
+    ''' returns a queryset of the evictable simruns, first to be evicted first '''
+    now = timezone.now()
+    simruns = SimRun.objects.filter(parent=None, data_folder__isnull=False, pinned=False)
+    simruns = simruns.exclude(complete=None, failed=None)
+    # refinements in flight merge the output of the simrun they refine when they finish
+    refining = SimRun.objects.filter(complete=None, failed=None, refined_from__isnull=False).values_list('refined_from', flat=True)
+    simruns = simruns.exclude(id__in=refining).annotate(last_use=Coalesce('last_access', 'complete', 'failed', 'created'))
+    simruns = simruns.filter(last_use__lt=now - timedelta(days=keep_days))
+    # each cache hit counts as hit_days days of recency
+    recency = ExpressionWrapper(DayNumber('last_use', output_field=FloatField()) + F('cache_hits') * float(hit_days), output_field=FloatField())
+    return simruns.annotate(recency=recency).order_by('recency', 'id')
+
+def evict(simrun):
+    '''
+    deletes the data folder of simrun, which stops being cachable, and returns the number of bytes reclaimed, or
+    None if the folder was evicted meanwhile
+    '''
+    folder = simrun.data_folder
+    # cache lookups stop matching before the folder goes
+    claimed = SimRun.objects.filter(id=simrun.id, data_folder=folder).update(data_folder=None, enable_cachefrom=False,
+                                                                              evicted=timezone.now())
+    if claimed == 0:
+        return None
+    SimRun.objects.filter(parent=simrun).update(data_folder=None)
+    reclaimed = get_tree_bytes(folder, unique=True) if os.path.isdir(folder) else 0
+    shutil.rmtree(folder, ignore_errors=True)
+    remove_legacy_link(folder)
+
+    # the files still linked from a cached copy are now counted with it
+    kept = (simrun.data_bytes or 0) - reclaimed
+    copy = SimRun.objects.filter(cache_source=simrun, data_folder__isnull=False, data_bytes__isnull=False).first()
+    if kept > 0 and copy:
+        SimRun.objects.filter(id=copy.id).update(data_bytes=F('data_bytes') + kept)
+    return reclaimed
+
+def enforce_budget(max_bytes, keep_days=7, hit_days=1, dry_run=False):
+    '''
+    evicts simruns until the data dir uses at most max_bytes. Returns (simruns evicted, bytes reclaimed, bytes used
+    before). A dry run only estimates the bytes reclaimed.
+    '''
+    used = get_used_bytes()
+    (evicted, reclaimed) = (0, 0)
+    if used <= max_bytes:
+        return (evicted, reclaimed, used)
+    for simrun in get_eviction_candidates(keep_days, hit_days).iterator():
+        if used - reclaimed <= max_bytes:
+            break
+        if dry_run:
+            freed = get_tree_bytes(simrun.data_folder, unique=True) if os.path.isdir(simrun.data_folder) else 0
+        else:
+            freed = evict(simrun)
+            if freed is None:
+                continue
+        evicted += 1
+        reclaimed += freed
+    return (evicted, reclaimed, used)
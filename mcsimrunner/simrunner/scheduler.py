@@ -0,0 +1,222 @@
+'''
+Scheduling policies and lanes for the runworker SimRun queue.
+
+A policy receives the queued simruns as a list of dicts (with at least 'id' and 'owner_username'),
+in insertion order, and returns those that may be started now, best candidate first. Policies with
+priority classes also set 'priority' on each candidate. Select a policy using the SCHEDULER_POLICY setting.
+
+Queued simruns are also classified by their expected cost in cpu-seconds into a short and a long
+lane, each of which has a number of reserved worker slots. Started simruns get their MPI rank count
+from a core budget.
+'''
+import threading
+import time
+import math
+import multiprocessing
+from datetime import timedelta
+
+from django.db.models import Sum
+from django.utils import timezone
+
+import mcweb.settings as settings
+from simrunner.models import SimRun
+
+class FifoPolicy():
+    ''' first come, first served '''
+    def order(self, candidates):
+        return sorted(candidates, key=lambda c: c['id'])
+
+class FairSharePolicy():
+    '''
+    Weighted fair-share across owner_username. Users are ranked by their consumed cpu-seconds
+    within the last usage_hours (completed runs plus the elapsed part of running runs) divided by
+    their weight. Priority classes are strict: a higher class is always served first. Users with
+    max_runs_pr_user running simruns are held back, except for subruns of their already running simruns.
+    '''
+    def __init__(self, max_runs_pr_user=0, weights=None, priorities=None, usage_hours=24):
+        self.max_runs_pr_user = max_runs_pr_user
+        self.weights = weights or {}
+        self.priorities = priorities or {}
+        self.usage_hours = usage_hours
+
+    def get_usage(self):
+        ''' returns ({username: cpu-seconds}, {username: number of running simruns}) '''
+        now = timezone.now()
+        usage = {}
+        running = {}
+
+        completed = SimRun.objects.filter(complete__gte=now - timedelta(hours=self.usage_hours), cpu_seconds__isnull=False)
+        for row in completed.values('owner_username').annotate(cpu=Sum('cpu_seconds')):
+            usage[row['owner_username']] = row['cpu']
+
+        # a split simrun counts as one run, but its cpu usage is that of its subruns. Followers use nothing.
+        for row in SimRun.objects.filter(started__isnull=False, complete=None, failed=None, leader=None).values('owner_username', 'started', 'mpi_ranks', 'parent', 'subruns_pending'):
+            u = row['owner_username']
+            if row['parent'] is None:
+                running[u] = running.get(u, 0) + 1
+            if row['subruns_pending'] == 0:
+                usage[u] = usage.get(u, 0) + (now - row['started']).total_seconds() * (row['mpi_ranks'] or 1)
+
+        return (usage, running)
+
+    def order(self, candidates):
+        (usage, running) = self.get_usage()
+
+        if self.max_runs_pr_user > 0:
+            candidates = [c for c in candidates if c.get('parent') or running.get(c['owner_username'], 0) < self.max_runs_pr_user]
+
+        def key(c):
+            u = c['owner_username']
+            share = usage.get(u, 0) / float(self.weights.get(u, 1))
+            return (-c['priority'], share, c['id'])
+
+        for c in candidates:
+            c['priority'] = self.priorities.get(c['owner_username'], 0)
+        return sorted(candidates, key=key)
+
+def get_policy():
+    ''' instantiates the policy configured in settings '''
+    name = getattr(settings, 'SCHEDULER_POLICY', 'fifo')
+    if name == 'fifo':
+        return FifoPolicy()
+    elif name == 'fairshare':
+        return FairSharePolicy(max_runs_pr_user=getattr(settings, 'SCHEDULER_MAX_RUNS_PR_USER', 0),
+                               weights=getattr(settings, 'SCHEDULER_USER_WEIGHTS', {}),
+                               priorities=getattr(settings, 'SCHEDULER_USER_PRIORITIES', {}),
+                               usage_hours=getattr(settings, 'SCHEDULER_USAGE_HOURS', 24))
+    raise Exception('unknown scheduling policy: %s' % name)
+
+SHORT = 'short'
+LONG = 'long'
+
+# max age in seconds of the ray rates returned by get_ray_rates
+RAY_RATE_MAX_AGE = 60
+# number of recently completed simruns used to estimate ray rates
+RAY_RATE_SAMPLES = 1000
+
+_ray_rates = None
+_ray_rates_time = 0
+def get_ray_rates():
+    ''' returns {(group_name, instr_displayname): rays pr. cpu-second}, based on recently completed simruns '''
+    global _ray_rates, _ray_rates_time
+    if _ray_rates is not None and time.time() - _ray_rates_time < RAY_RATE_MAX_AGE:
+        return _ray_rates
+
+    rays = {}
+    cpu = {}
+    completed = SimRun.objects.filter(cpu_seconds__gt=0).order_by('-complete')
+    for row in completed.values('group_name', 'instr_displayname', 'neutrons', 'scanpoints', 'cpu_seconds')[:RAY_RATE_SAMPLES]:
+        k = (row['group_name'], row['instr_displayname'])
+        rays[k] = rays.get(k, 0) + row['neutrons'] * row['scanpoints']
+        cpu[k] = cpu.get(k, 0) + row['cpu_seconds']
+
+    _ray_rates = dict((k, rays[k] / cpu[k]) for k in rays)
+    _ray_rates_time = time.time()
+    return _ray_rates
+
+def expected_cpu_seconds(c, rates):
+    ''' expected cost of the queued simrun c, a dict with group_name, instr_displayname, neutrons and scanpoints '''
+    rate = rates.get((c['group_name'], c['instr_displayname']), getattr(settings, 'LANE_DEFAULT_RAY_RATE', 1e6))
+    return c['neutrons'] * c['scanpoints'] / float(rate)
+
+def assign_lanes(candidates, rates):
+    ''' sets 'expected_cpu_seconds' and 'lane' on every candidate '''
+    short_max = getattr(settings, 'LANE_SHORT_MAX_CPU_SECS', 60)
+    for c in candidates:
+        c['expected_cpu_seconds'] = expected_cpu_seconds(c, rates)
+        c['lane'] = SHORT if c['expected_cpu_seconds'] <= short_max else LONG
+    return candidates
+
+def lane_order(candidates):
+    ''' short lane first, highest priority class first and shortest expected job first within it, then the long lane in policy order '''
+    short = [c for c in candidates if c['lane'] == SHORT]
+    short = sorted(short, key=lambda c: (-c.get('priority', 0), c['expected_cpu_seconds']))
+    return short + [c for c in candidates if c['lane'] == LONG]
+
+class LaneSlots():
+    '''
+    Worker slot accounting for the lanes. A lane may take any free slot, except those needed to honour
+    the unused reservations of the other lanes. Only the main loop acquires, threads release.
+    '''
+    def __init__(self, total, reserved):
+        if sum(reserved.values()) > total:
+            raise Exception('lane reservations exceed the number of slots (%d)' % total)
+        self.total = total
+        self.reserved = reserved
+        self.in_use = dict((lane, 0) for lane in reserved)
+        self.lock = threading.Lock()
+
+    def available(self, lane):
+        with self.lock:
+            free = self.total - sum(self.in_use.values())
+            held = sum(max(0, self.reserved[l] - self.in_use[l]) for l in self.reserved if l != lane)
+            return free - held > 0
+
+    def acquire(self, lane):
+        with self.lock:
+            self.in_use[lane] += 1
+
+    def release(self, lane):
+        with self.lock:
+            self.in_use[lane] -= 1
+
+    def free(self):
+        with self.lock:
+            return self.total - sum(self.in_use.values())
+
+    def __str__(self):
+        return ', '.join(['%s: %d/%d reserved' % (l, self.in_use[l], self.reserved[l]) for l in sorted(self.reserved)])
+
+def get_lane_slots():
+    ''' instantiates lane slots as configured in settings '''
+    return LaneSlots(settings.MAX_THREADS, {SHORT: getattr(settings, 'LANE_SHORT_RESERVED', 0),
+                                            LONG: getattr(settings, 'LANE_LONG_RESERVED', 0)})
+
+class CoreBudget():
+    '''
+    Keeps the total number of MPI ranks of concurrently running simruns within the number of cores.
+    Each run is sized from its ray count. When other simruns are waiting to start, it is left with a fair
+    part of the free cores, and at most max_ranks. Otherwise it may use all free cores, or max_idle_ranks.
+    '''
+    def __init__(self, cores, max_ranks, min_rays_pr_rank, max_idle_ranks=0):
+        self.cores = cores
+        self.max_ranks = max_ranks
+        self.min_rays_pr_rank = min_rays_pr_rank
+        self.max_idle_ranks = max_idle_ranks
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+    def free(self):
+        with self.lock:
+            return self.cores - self.in_use
+
+    def allocate(self, rays, queue_depth=0):
+        '''
+        returns the number of ranks reserved for a run of rays rays pr. mpirun (at least one), or 0 if no core is
+        free. Scan points run one mpirun after the other, so rays is that of a single point.
+        '''
+        wanted = max(1, int(math.ceil(rays / float(self.min_rays_pr_rank))))
+        with self.lock:
+            free = self.cores - self.in_use
+            if free < 1:
+                return 0
+            if queue_depth == 0:
+                ranks = min(wanted, free, self.max_idle_ranks or free)
+            else:
+                ranks = min(wanted, self.max_ranks, max(1, free // (queue_depth + 1)))
+            self.in_use += ranks
+            return ranks
+
+    def release(self, ranks):
+        with self.lock:
+            self.in_use -= ranks
+
+    def __str__(self):
+        return '%d/%d cores in use' % (self.in_use, self.cores)
+
+def get_core_budget():
+    ''' instantiates the core budget as configured in settings '''
+    return CoreBudget(getattr(settings, 'WORKER_CORES', None) or multiprocessing.cpu_count(),
+                      settings.MPI_PR_WORKER,
+                      getattr(settings, 'MPI_MIN_RAYS_PR_RANK', 1000000),
+                      getattr(settings, 'MPI_MAX_RANKS_PR_RUN', 0))
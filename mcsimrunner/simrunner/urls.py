@@ -12,6 +12,11 @@ urlpatterns = [
     
     url(r'^startsim/?$', views.instrument_post, name="instrument_post" ),
 
+    url(r'^simrun/(?P<sim_id>[\w-]+)/status.json$', views.simrun_status_json, name="simrun_status_json"),
+    url(r'^simrun/(?P<sim_id>[\w-]+)/cancel/?$', views.simrun_cancel, name="simrun_cancel"),
+    url(r'^simrun/(?P<sim_id>[\w-]+)/(?P<stream>stdout|stderr)/?$', views.simrun_output, name="simrun_output"),
+    url(r'^simrun/(?P<sim_id>[\w-]+)/simrun.tar.gz$', views.simrun_download, name="simrun_download"),
+    url(r'^simrun/(?P<sim_id>[\w-]+)/(?P<monitor>[\w.-]+).zip$', views.simrun_sweep_zip, name="simrun_sweep_zip"),
     url(r'^simrun/(?P<sim_id>[\w-]+)/?$', views.simrun, name="simrun"),
     
     url(r'^recent/?$', views.recent, name="recent"),
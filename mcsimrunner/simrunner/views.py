@@ -5,12 +5,31 @@ from django.utils import timezone
 from django.contrib.auth import authenticate, login, logout
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
-from os.path import basename
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse, Http404
+from os.path import basename, join, isfile, getsize, splitext
+import gzip
+import time
+import hashlib
+import threading
 from models import InstrGroup, Instrument, SimRun
+from wakeup import notify_workers
+from resultcache import get_simrun_cache_key, get_instr_hash, get_cache_match, load_cache, find_leader, follow
+from retention import touch
+from archives import stream_tarball, get_sweep_zip, TAR_NAME
 import json
 from django.views.decorators.clickjacking import xframe_options_exempt
 from mcweb.settings import DEFAULT_GROUP, DEFAULT_INSTR
+import mcweb.settings as settings
+
+# max number of bytes returned by simrun_output when tailing
+OUTPUT_TAIL_BYTES = 65536
+
+# simrun_status_json long-polling: max secs to hold a request, the db re-read interval, and the number of requests
+# this process may hold at once
+STATUS_LONGPOLL_SECS = getattr(settings, 'STATUS_LONGPOLL_SECS', 10)
+STATUS_LONGPOLL_INTERVAL = getattr(settings, 'STATUS_LONGPOLL_INTERVAL', 1)
+longpoll_slots = threading.BoundedSemaphore(getattr(settings, 'STATUS_LONGPOLL_MAX_HELD', 4))
+
 @xframe_options_exempt
 
 def home(req):
@@ -78,13 +97,13 @@ def logout_slim(req):
 @login_required
 def recent(req):
     ''' returns a link to recent simruns '''
-    all_simruns = SimRun.objects.filter(owner_username=req.user)
+    all_simruns = SimRun.objects.filter(owner_username=req.user, parent=None)
     
     # make sure we only work on instances with valied data_folder atributes
     all_simruns = filter(lambda s: s.data_folder is not None, all_simruns)
     
     # create a list of template-friendly records from the simruns belonging to this user 
-    datafolder_simname = map(lambda s: [s.data_folder, basename(s.data_folder)], all_simruns)
+    datafolder_simname = map(lambda s: [s.id, basename(s.data_folder)], all_simruns)
     
     # most recent simruns first 
     datafolder_simname = reversed(datafolder_simname)
@@ -137,10 +156,12 @@ def instrument_post(req):
     instr_displayname = form.get('instr_displayname')
     
     neutrons = int(float(form.get('neutrons')))
-    scanpoints = form.get('scanpoints')
-    seed = form.get('seed')
+    scanpoints = int(form.get('scanpoints'))
+    seed = int(form.get('seed'))
     gravity = bool(form.get('gravity'))
     recalc = bool(form.get('force_recalc'))
+    target_error = float(form.get('target_error')) if form.get('target_error') else None
+    target_monitor = form.get('target_monitor') or None
 
     params_default = json.loads(form.get('params_jsonified'))
     params=[]
@@ -152,10 +173,158 @@ def instrument_post(req):
     simrun = SimRun(group_name=group_name, instr_displayname=instr_displayname, 
                     owner_username=owner_username,
                     neutrons=neutrons, scanpoints=scanpoints, seed=seed, gravity=gravity,
-                    params=params, force_run=recalc)
+                    params=params, force_run=recalc, target_error=target_error, target_monitor=target_monitor)
+    simrun.cache_key = get_simrun_cache_key(simrun)
+    simrun.instr_hash = get_instr_hash(group_name, instr_displayname)
+
+    # cache hits are completed right here, so that the worker queue only holds simruns that need simulating
+    match = None if recalc else get_cache_match(simrun)
+    if match:
+        simrun.started = timezone.now()
+        simrun.save()
+        try:
+            load_cache(simrun, match)
+            return redirect('simrun', sim_id=simrun.id)
+        except Exception:
+            # leave it to the worker, load_cache has removed whatever it created
+            simrun.started = None
+            simrun.complete = None
+            simrun.data_folder = None
+            simrun.cache_source = None
+
+    # identical simruns in flight complete this one as well
+    leader = None if recalc else find_leader(simrun)
+    if leader:
+        simrun.started = timezone.now()
+        simrun.save()
+        follow(simrun, leader, 'web')
+        return redirect('simrun', sim_id=simrun.id)
+
     simrun.save()
+    notify_workers()
     return redirect('simrun', sim_id=simrun.id)
 
+@login_required
+def simrun_cancel(req, sim_id):
+    ''' cancels a queued or running simulation, allowed for its owner and for staff '''
+    simrun = SimRun.objects.get(id=sim_id)
+    if req.method == 'POST' and (simrun.owner_username == req.user.username or req.user.is_staff):
+        simrun.cancel()
+    return redirect('simrun', sim_id=simrun.id)
+
+@login_required
+def simrun_output(req, sim_id, stream):
+    ''' serves the stdout or stderr of a simulation, also while it is running, "?tail=1" gives only the last part '''
+    simrun = SimRun.objects.get(id=sim_id)
+    if not simrun.data_folder:
+        return HttpResponse('no %s data yet' % stream, content_type='text/plain')
+
+    filename = join(simrun.data_folder, '%s.txt' % stream)
+    if isfile(filename):
+        f = open(filename, 'rb')
+        if req.GET.get('tail'):
+            f.seek(max(0, getsize(filename) - OUTPUT_TAIL_BYTES))
+    elif isfile(filename + '.gz'):
+        f = gzip.open(filename + '.gz', 'rb')
+    else:
+        return HttpResponse('no %s data' % stream, content_type='text/plain')
+
+    return FileResponse(f, content_type='text/plain')
+
+@login_required
+def simrun_download(req, sim_id):
+    ''' serves the tarball of the output of a completed simulation, which is compressed on the first request '''
+    simrun = SimRun.objects.get(id=sim_id)
+    if not simrun.complete or not simrun.data_folder:
+        raise Http404('no output to download')
+
+    cachepath = join(simrun.data_folder, TAR_NAME)
+    if isfile(cachepath):
+        response = FileResponse(open(cachepath, 'rb'), content_type='application/gzip')
+    else:
+        response = StreamingHttpResponse(stream_tarball(simrun.data_folder), content_type='application/gzip')
+    response['Content-Disposition'] = 'attachment; filename="%s.tar.gz"' % basename(simrun.data_folder)
+    return response
+
+@login_required
+def simrun_sweep_zip(req, sim_id, monitor):
+    ''' serves the zip of the data files of a monitor at every scan point of a completed sweep '''
+    simrun = SimRun.objects.get(id=sim_id)
+    datafiles = [basename(d) for d in simrun.data_files if splitext(basename(d))[0] == monitor]
+    if not simrun.complete or not simrun.data_folder or simrun.scanpoints < 2 or not datafiles:
+        raise Http404('no such monitor')
+
+    response = FileResponse(open(get_sweep_zip(simrun.data_folder, datafiles[0], simrun.scanpoints), 'rb'), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="%s.zip"' % monitor
+    return response
+
+def get_eta_display(record):
+    ''' returns the time left of a status record as a string, or None if unknown. Also done by simrun_status.js. '''
+    if record['eta_secs'] is None:
+        return None
+    # the progress may be a few seconds old
+    secs = max(0, int(record['eta_secs'] - (time.time() - record['time'])))
+    if secs < 60:
+        return '%d secs' % secs
+    return '%d mins' % round(secs / 60.0)
+
+def get_status_record(sim_id):
+    '''
+    returns the state of a simrun as shown on the status page, reading only the fields needed. eta_secs is the
+    time left as estimated at the unix time time, which the page counts down from.
+    '''
+    simrun = SimRun.objects.only('started', 'complete', 'failed', 'cancelled', 'progress_str', 'leader').get(id=sim_id)
+    # followers show the progress of the simrun they wait for
+    if simrun.leader_id and not simrun.complete:
+        progress = SimRun.objects.only('progress_str').get(id=simrun.leader_id).progress
+    else:
+        progress = simrun.progress
+    percent = int(progress['percent']) if progress.get('percent') is not None else None
+    # finished simruns go through the simrun view, which records the use of their results
+    redirect_url = None
+    if simrun.failed or simrun.complete:
+        redirect_url = '/simrun/%s/' % sim_id
+    return {'status': simrun.status(), 'percent': percent, 'eta_secs': progress.get('eta_secs'), 'time': progress.get('time'),
+            'redirect': redirect_url}
+
+def get_status_etag(record):
+    ''' the ETag of a status record, which leaves out the time estimates, so that held long-polls are released only by changes '''
+    shown = json.dumps([record['status'], record['percent'], record['redirect']])
+    return '"%s"' % hashlib.md5(shown).hexdigest()
+
+@login_required
+def simrun_status_json(req, sim_id):
+    '''
+    Lightweight simrun status for status.html. Supports ETag/If-None-Match, and long-polling: with "?wait=1",
+    the response is held back until the status differs from the ETag given, or STATUS_LONGPOLL_SECS have passed.
+    When all long-poll slots of this process are taken, the request is answered right away, without the
+    X-Long-Poll header, and the client should back off.
+    '''
+    etag = req.META.get('HTTP_IF_NONE_MATCH')
+    held = bool(req.GET.get('wait')) and longpoll_slots.acquire(False)
+    try:
+        deadline = time.time() + (STATUS_LONGPOLL_SECS if held else 0)
+        while True:
+            record = get_status_record(sim_id)
+            new_etag = get_status_etag(record)
+            if new_etag != etag:
+                record['now'] = time.time()
+                response = HttpResponse(json.dumps(record, sort_keys=True), content_type='application/json')
+                break
+            if time.time() >= deadline:
+                response = HttpResponse(status=304)
+                break
+            time.sleep(STATUS_LONGPOLL_INTERVAL)
+    finally:
+        if held:
+            longpoll_slots.release()
+
+    if held:
+        response['X-Long-Poll'] = 'held'
+    response['ETag'] = new_etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
 @login_required
 def simrun(req, sim_id):
     ''' Simulation run waiting page. '''
@@ -164,17 +333,24 @@ def simrun(req, sim_id):
     if simrun.failed:
         # TODO: make a static fail html page also named browse.html
         # TODO: ensure static page generation only happens once
-        return render(req, 'fail.html', {'instr_displayname': simrun.instr_displayname, 'fail_str': simrun.fail_str, 'data_folder' : simrun.data_folder})
+        return render(req, 'fail.html', {'instr_displayname': simrun.instr_displayname, 'fail_str': simrun.fail_str, 'data_folder' : simrun.data_folder, 'sim_id': simrun.id})
+
+    elif simrun.complete and simrun.evicted:
+        return render(req, 'fail.html', {'instr_displayname': simrun.instr_displayname, 'sim_id': simrun.id,
+                                         'fail_str': 'The output of this simulation has been deleted to free disk space, please run it again.'})
 
     elif simrun.complete:
         # redirect to static
+        touch(simrun.id)
         return redirect('/%s/browse.html' % simrun.data_folder)
     
     # simrun live status 
     else:
+        record = get_status_record(sim_id)
         return render(req, 'status.html', {'group_name': simrun.group_name, 'instr_displayname': simrun.instr_displayname,
                                            'neutrons': simrun.neutrons, 'seed': simrun.seed,
                                            'scanpoints': simrun.scanpoints, 'params': simrun.params,
                                            'status': simrun.status, 'date_time_created': timezone.localtime(simrun.created).strftime("%H:%M:%S"),
-                                           'data_folder' : simrun.data_folder})
+                                           'data_folder' : simrun.data_folder, 'sim_id': simrun.id, 'cancelled': simrun.cancelled,
+                                           'percent': record['percent'], 'eta': get_eta_display(record)})
 
@@ -0,0 +1,78 @@
+'''
+Wakeup signalling between the web views and runworker processes.
+
+Every runworker binds a unix datagram socket in WORKER_WAKEUP_DIR. Views call notify_workers()
+after inserting a SimRun, which sends a one-byte datagram to every socket in that dir. Workers
+on other hosts never receive these and fall back to polling every WORKER_POLL_SECS.
+'''
+import os
+import errno
+import socket
+import select
+
+import mcweb.settings as settings
+
+def get_wakeup_dir():
+    return getattr(settings, 'WORKER_WAKEUP_DIR', os.path.join(settings.BASE_DIR, 'wakeup'))
+
+def notify_workers():
+    ''' wakes up all local runworker processes, never blocks and never raises '''
+    wakeup_dir = get_wakeup_dir()
+    try:
+        socknames = [f for f in os.listdir(wakeup_dir) if f.endswith('.sock')]
+    except OSError:
+        return
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    s.setblocking(0)
+    try:
+        for f in socknames:
+            path = os.path.join(wakeup_dir, f)
+            try:
+                s.sendto(b'w', path)
+            except socket.error as e:
+                # a dead worker leaves a stale socket file behind
+                if e.errno == errno.ECONNREFUSED:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                # EAGAIN means that the worker already has unread wakeups pending
+    finally:
+        s.close()
+
+class WakeupListener():
+    ''' the runworker end of the wakeup channel '''
+    def __init__(self, name):
+        wakeup_dir = get_wakeup_dir()
+        if not os.path.isdir(wakeup_dir):
+            os.makedirs(wakeup_dir)
+        self.path = os.path.join(wakeup_dir, '%s.sock' % name)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(0)
+        # the web server usually runs as another user
+        os.chmod(self.path, 0o666)
+
+    def wait(self, timeout):
+        ''' blocks until a wakeup is received or timeout secs have passed, returns True on wakeup '''
+        (readable, _, _) = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return False
+        # collapse any number of pending wakeups into one
+        while True:
+            try:
+                self.sock.recv(64)
+            except socket.error:
+                break
+        return True
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,61 @@
+// polls /simrun/<id>/status.json, updating status.html in place and redirecting when the simulation is done
+
+// the time left is counted down here, as the server only responds when the status or percent changes
+var etaDeadline = null;
+var percentShown = null;
+
+function showProgress() {
+    if (percentShown === null) {
+        return;
+    }
+    var text = percentShown + '%';
+    if (etaDeadline !== null) {
+        var secs = Math.max(0, Math.round(etaDeadline - Date.now() / 1000));
+        text += ', about ' + (secs < 60 ? secs + ' secs' : Math.round(secs / 60) + ' mins') + ' left';
+    }
+    document.getElementById('progress').textContent = text;
+    document.getElementById('progress_p').style.display = '';
+}
+setInterval(showProgress, 1000);
+
+// ms to wait before polling again when the server could not hold the request, doubled up to POLL_MAX_DELAY
+var POLL_MIN_DELAY = 1000;
+var POLL_MAX_DELAY = 30000;
+var pollDelay = POLL_MIN_DELAY;
+
+function pollStatus(simId, etag) {
+    var retry = function() {
+        pollDelay = Math.min(2 * pollDelay, POLL_MAX_DELAY);
+        setTimeout(function() { pollStatus(simId, etag); }, pollDelay);
+    };
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', '/simrun/' + simId + '/status.json?wait=1');
+    if (etag) {
+        xhr.setRequestHeader('If-None-Match', etag);
+    }
+    xhr.onload = function() {
+        if (xhr.status == 200) {
+            var s = JSON.parse(xhr.responseText);
+            if (s.redirect) {
+                window.location = s.redirect;
+                return;
+            }
+            document.getElementById('status').textContent = s.status;
+            percentShown = s.percent;
+            // eta_secs was estimated at server time s.time, the response was sent at server time s.now
+            etaDeadline = s.eta_secs !== null ? Date.now() / 1000 + s.eta_secs - (s.now - s.time) : null;
+            showProgress();
+            pollDelay = POLL_MIN_DELAY;
+            pollStatus(simId, xhr.getResponseHeader('ETag'));
+        } else if (xhr.status == 304 && xhr.getResponseHeader('X-Long-Poll')) {
+            // long-poll timed out without changes
+            pollDelay = POLL_MIN_DELAY;
+            pollStatus(simId, etag);
+        } else {
+            // no change, and the server was too busy to hold the request
+            retry();
+        }
+    };
+    xhr.onerror = retry;
+    xhr.send();
+}
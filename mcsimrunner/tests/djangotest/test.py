@@ -1,6 +1,32 @@
 from django.test import TestCase
 from django.utils import timezone
+from datetime import timedelta
+from django.contrib.auth.models import User
+import json
+import os
+import shutil
+import tempfile
+import tarfile
+import zipfile
+import io
+import gzip
+import sys
+import subprocess
+import time
 from signupper.models import Signup
+from simrunner.models import SimRun
+from simrunner import views
+from simrunner.management.commands import runworker
+from simrunner.mcmerge import merge_dirs, write_sweep_summary, McCodeData, relative_error
+from simrunner.resultcache import get_cache_key, get_simrun_cache_key, get_file_hash, get_sweep_params, find_cached_points, link_tree, get_cache_match, find_leader, follow, resolve_orphans, get_refinement_base
+from simrunner.retention import get_eviction_candidates, get_tree_bytes, evict, get_used_bytes, enforce_budget
+from simrunner.datadirs import get_data_basedir, get_data_folder, get_simrun_folder, shard_folder
+from simrunner import resultcache
+from simrunner.artifacts import link_artifact
+import mcweb.settings as settings
+from simrunner.archives import stream_tarball, get_sweep_zip
+from simrunner.wakeup import WakeupListener, notify_workers
+from simrunner.scheduler import FairSharePolicy, LaneSlots, CoreBudget, assign_lanes, lane_order
 
 class DjangoTest(TestCase):
    '''
@@ -56,3 +82,969 @@ class SignupTest(TestCase):
         self.assertTrue(signup.created < timestamp_after)
         
         
+
+class SimRunClaimTest(TestCase):
+    '''
+    Test atomic claiming of queued SimRun objects by runworker
+    '''
+
+    def setUp(self):
+        self.simrun = SimRun(owner_username='corona', group_name='test', instr_displayname='templateSANS2', params=[])
+        self.simrun.save()
+
+    def test_claim_once(self):
+        claimed = runworker.get_and_start_new_simrun()
+        self.assertEqual(claimed.id, self.simrun.id)
+        self.assertEqual(claimed.worker_id, runworker.get_worker_id())
+        self.assertIsNotNone(claimed.started)
+
+        # the same simrun must not be handed out twice
+        self.assertIsNone(runworker.claim_simrun(self.simrun.id))
+        self.assertIsNone(runworker.get_and_start_new_simrun())
+
+class WakeupTest(TestCase):
+    '''
+    Test wakeup signalling from the views to runworker processes
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.wakeup_dir = getattr(settings, 'WORKER_WAKEUP_DIR', None)
+        settings.WORKER_WAKEUP_DIR = os.path.join(self.tmp, 'wakeup')
+
+    def tearDown(self):
+        settings.WORKER_WAKEUP_DIR = self.wakeup_dir
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        listener = WakeupListener('worker')
+        try:
+            self.assertFalse(listener.wait(0))
+            notify_workers()
+            notify_workers()
+            started = time.time()
+            self.assertTrue(listener.wait(10))
+            self.assertTrue(time.time() - started < 5)
+            # pending wakeups are collapsed into one
+            self.assertFalse(listener.wait(0))
+        finally:
+            listener.close()
+        self.assertEqual(os.listdir(settings.WORKER_WAKEUP_DIR), [])
+
+    def test_no_listener(self):
+        # neither a missing dir nor a stale socket raises, stale sockets are removed
+        notify_workers()
+        listener = WakeupListener('worker')
+        listener.sock.close()
+        notify_workers()
+        self.assertEqual(os.listdir(settings.WORKER_WAKEUP_DIR), [])
+
+class FairSharePolicyTest(TestCase):
+    '''
+    Test ordering of queued SimRun objects by the fair-share scheduling policy
+    '''
+
+    def queue(self, owner_username, n):
+        for i in range(n):
+            SimRun(owner_username=owner_username, group_name='test', instr_displayname='templateSANS2', params=[]).save()
+
+    def candidates(self):
+        return list(SimRun.objects.filter(started=None).order_by('id').values('id', 'owner_username'))
+
+    def test_heavy_user_last(self):
+        SimRun(owner_username='heavy', params=[], started=timezone.now(), complete=timezone.now(), cpu_seconds=1000).save()
+        self.queue('heavy', 3)
+        self.queue('light', 1)
+
+        ordered = FairSharePolicy().order(self.candidates())
+        self.assertEqual(ordered[0]['owner_username'], 'light')
+        self.assertEqual(len(ordered), 4)
+
+    def test_max_runs_and_priority(self):
+        SimRun(owner_username='busy', params=[], started=timezone.now()).save()
+        self.queue('busy', 2)
+        self.queue('student', 1)
+        self.queue('teacher', 1)
+
+        ordered = FairSharePolicy(max_runs_pr_user=1, priorities={'teacher': 1}).order(self.candidates())
+        self.assertEqual([c['owner_username'] for c in ordered], ['teacher', 'student'])
+
+class LaneTest(TestCase):
+    '''
+    Test short/long lane classification and slot reservations
+    '''
+
+    def test_lane_order(self):
+        candidates = [dict(id=1, group_name='g', instr_displayname='i', neutrons=int(1e9), scanpoints=1),
+                      dict(id=2, group_name='g', instr_displayname='i', neutrons=int(1e6), scanpoints=10),
+                      dict(id=3, group_name='g', instr_displayname='i', neutrons=int(1e5), scanpoints=1)]
+        ordered = lane_order(assign_lanes(candidates, {('g', 'i'): 1e6}))
+        self.assertEqual([c['id'] for c in ordered], [3, 2, 1])
+        self.assertEqual([c['lane'] for c in ordered], ['short', 'short', 'long'])
+
+    def test_lane_priority(self):
+        for (owner, neutrons) in [('student', int(1e5)), ('teacher', int(1e7)), ('teacher', int(1e6)), ('student', int(1e9))]:
+            SimRun(owner_username=owner, group_name='g', instr_displayname='i', neutrons=neutrons, params=[]).save()
+        candidates = list(SimRun.objects.order_by('id').values('id', 'owner_username', 'group_name', 'instr_displayname', 'neutrons', 'scanpoints', 'parent'))
+        candidates = assign_lanes(FairSharePolicy(priorities={'teacher': 1}).order(candidates), {('g', 'i'): 1e6})
+
+        # priority classes stay strict in the short lane, shortest job first within a class
+        ordered = lane_order(candidates)
+        self.assertEqual([(c['owner_username'], c['neutrons']) for c in ordered],
+                         [('teacher', int(1e6)), ('teacher', int(1e7)), ('student', int(1e5)), ('student', int(1e9))])
+
+    def test_reserved_slots(self):
+        slots = LaneSlots(3, {'short': 1, 'long': 1})
+        slots.acquire('long')
+        self.assertTrue(slots.available('long'))
+        slots.acquire('long')
+        self.assertFalse(slots.available('long'))
+        self.assertTrue(slots.available('short'))
+        slots.release('long')
+        slots.acquire('short')
+        slots.acquire('short')
+        self.assertFalse(slots.available('short'))
+
+    def test_core_budget(self):
+        budget = CoreBudget(cores=8, max_ranks=4, min_rays_pr_rank=int(1e6))
+        self.assertEqual(budget.allocate(int(1e5)), 1)
+        self.assertEqual(budget.allocate(int(1e6), queue_depth=3), 1)
+        # with others queued, a run gets a fair part of the free cores, at most max_ranks
+        self.assertEqual(budget.allocate(int(1e9), queue_depth=1), 3)
+        self.assertEqual(budget.allocate(int(1e9), queue_depth=1), 1)
+        budget.release(4)
+        self.assertEqual(budget.allocate(int(1e9), queue_depth=1), 3)
+        self.assertEqual(budget.free(), 3)
+
+    def test_core_budget_idle(self):
+        # with an empty queue, a large run takes the idle cores beyond max_ranks
+        budget = CoreBudget(cores=8, max_ranks=4, min_rays_pr_rank=int(1e6))
+        self.assertEqual(budget.allocate(int(1e5)), 1)
+        self.assertEqual(budget.allocate(int(1e9)), 7)
+        self.assertEqual(budget.allocate(int(1e9)), 0)
+        budget = CoreBudget(cores=8, max_ranks=4, min_rays_pr_rank=int(1e6), max_idle_ranks=6)
+        self.assertEqual(budget.allocate(int(1e9)), 6)
+        self.assertEqual(budget.allocate(int(3e6)), 2)
+
+class DirectRunTest(TestCase):
+    '''
+    Test the choice between running the instrument binary directly and running mcrun
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        open(os.path.join(self.tmp, 'test.out'), 'w').write('binary')
+        self.simrun = SimRun(instr_displayname='test', data_folder=self.tmp, neutrons=10**5, mpi_ranks=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_use_direct_run(self):
+        self.assertTrue(runworker.use_direct_run(self.simrun))
+        self.assertFalse(runworker.use_direct_run(self.simrun, settings.DIRECT_RUN_MAX_RAYS + 1))
+        self.simrun.neutrons = settings.DIRECT_RUN_MAX_RAYS + 1
+        self.assertFalse(runworker.use_direct_run(self.simrun))
+        self.assertTrue(runworker.use_direct_run(self.simrun, 1000))
+
+        self.simrun.neutrons = 10**5
+        self.simrun.mpi_ranks = 4
+        self.assertFalse(runworker.use_direct_run(self.simrun))
+        self.simrun.mpi_ranks = 1
+        self.simrun.scanpoints = 3
+        self.assertFalse(runworker.use_direct_run(self.simrun))
+        self.simrun.scanpoints = 1
+        os.remove(os.path.join(self.tmp, 'test.out'))
+        self.assertFalse(runworker.use_direct_run(self.simrun))
+
+class CancelTest(TestCase):
+    '''
+    Test cancellation of SimRun objects and the resource limits of instrument runs
+    '''
+
+    def setUp(self):
+        self.limits = dict((k, getattr(settings, k)) for k in ['SIM_MAX_WALLTIME_SECS', 'SIM_MAX_CPU_SECS', 'SIM_MAX_MEMORY_MB'])
+        self.simrun = SimRun(owner_username='corona', params=[], data_folder='.')
+        self.simrun.save()
+
+    def tearDown(self):
+        for k in self.limits:
+            setattr(settings, k, self.limits[k])
+
+    def start(self, cmd):
+        ''' starts cmd like the worker does, with its output going to a file instead of to the test output '''
+        self.output = tempfile.TemporaryFile()
+        return subprocess.Popen(cmd, shell=True, preexec_fn=runworker.limit_resources, stdout=self.output, stderr=subprocess.STDOUT)
+
+    def read_output(self):
+        self.output.seek(0)
+        return self.output.read()
+
+    def get_group_procs(self, pgid, wait_secs=2):
+        ''' returns the pids of the live (not zombie) processes in the process group pgid, waiting for them to exit '''
+        deadline = time.time() + wait_secs
+        while True:
+            procs = self.list_group_procs(pgid)
+            if not procs or time.time() > deadline:
+                return procs
+            time.sleep(0.1)
+
+    def list_group_procs(self, pgid):
+        procs = []
+        for pid in [p for p in os.listdir('/proc') if p.isdigit()]:
+            try:
+                fields = open('/proc/%s/stat' % pid).read().rsplit(')', 1)[1].split()
+            except IOError:
+                continue
+            if int(fields[2]) == pgid and fields[0] != 'Z':
+                procs.append(int(pid))
+        return procs
+
+    def test_cancel_queued(self):
+        self.simrun.cancel()
+        simrun = SimRun.objects.get(id=self.simrun.id)
+        self.assertEqual(simrun.status(), 'Cancelled')
+        self.assertTrue(simrun.failed)
+        self.assertTrue(simrun.started)
+
+    def test_cancel_running(self):
+        self.simrun.started = timezone.now()
+        self.simrun.save()
+        process = self.start('sleep 30 & sleep 30')
+        self.simrun.cancel()
+        simrun = SimRun.objects.get(id=self.simrun.id)
+        self.assertTrue(simrun.cancelled)
+        self.assertIsNone(simrun.failed)
+
+        # the worker terminates the whole process group
+        self.assertRaisesRegexp(Exception, 'cancelled', runworker.wait_process, simrun, process)
+        self.assertEqual(self.get_group_procs(process.pid), [])
+        self.assertRaisesRegexp(Exception, 'cancelled', runworker.check_cancelled, simrun)
+
+    def test_cancel_subrun(self):
+        self.simrun.started = timezone.now()
+        self.simrun.save()
+        runworker.split_simrun(self.simrun, 3)
+        subruns = list(self.simrun.subruns.order_by('subrun_index'))
+        subruns[0].cancel()
+
+        parent = SimRun.objects.get(id=self.simrun.id)
+        self.assertEqual(parent.status(), 'Error')
+        self.assertEqual(parent.fail_str, 'subrun 0: Cancelled.')
+        self.assertEqual(SimRun.objects.filter(parent=parent, cancelled__isnull=False).count(), 3)
+
+    def test_cancel_split(self):
+        self.simrun.started = timezone.now()
+        self.simrun.save()
+        runworker.split_simrun(self.simrun, 3)
+        self.simrun.cancel()
+
+        parent = SimRun.objects.get(id=self.simrun.id)
+        self.assertEqual(parent.fail_str, 'Cancelled.')
+        self.assertEqual(SimRun.objects.filter(parent=parent, cancelled__isnull=False).count(), 3)
+
+    def test_limits(self):
+        settings.SIM_MAX_WALLTIME_SECS = 1
+        self.assertRaisesRegexp(Exception, 'timed out', runworker.wait_process, self.simrun, self.start('sleep 30'))
+
+        settings.SIM_MAX_WALLTIME_SECS = 0
+        settings.SIM_MAX_CPU_SECS = 1
+        process = self.start('%s -c "while True: pass"' % sys.executable)
+        self.assertRaisesRegexp(Exception, 'killed by signal', runworker.wait_process, self.simrun, process)
+
+        settings.SIM_MAX_CPU_SECS = 0
+        settings.SIM_MAX_MEMORY_MB = 100
+        process = self.start('%s -c "x = 500 * 1024 * 1024 * \' \'"' % sys.executable)
+        runworker.wait_process(self.simrun, process)
+        self.assertNotEqual(process.returncode, 0)
+        self.assertTrue('MemoryError' in self.read_output())
+
+class ProgressReporterTest(TestCase):
+    '''
+    Test parsing of mcrun progress output into SimRun.progress
+    '''
+
+    def test_trace_eta(self):
+        simrun = SimRun(owner_username='corona', params=[], data_folder='/nonexisting')
+        simrun.save()
+        progress = runworker.ProgressReporter(simrun)
+        progress.feed('Instrument: templateSANS2.instr\nTrace ETA 1.5 [min] % 10 ')
+        progress.feed('20 30 ')
+        progress.update(force=True)
+        self.assertEqual(SimRun.objects.get(id=simrun.id).progress['percent'], 30)
+
+class OutputTest(TestCase):
+    '''
+    Test streaming of mcrun output to disk, with truncation and compression
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.compress_min_bytes = settings.SIM_OUTPUT_COMPRESS_MIN_BYTES
+
+    def tearDown(self):
+        settings.SIM_OUTPUT_COMPRESS_MIN_BYTES = self.compress_min_bytes
+        shutil.rmtree(self.tmp)
+
+    def test_truncation(self):
+        (r, w) = os.pipe()
+        os.write(w, b'x' * 300)
+        os.close(w)
+        filename = os.path.join(self.tmp, 'stdout.txt')
+        runworker.pump_pipe(os.fdopen(r, 'rb'), filename, max_bytes=100)
+        data = open(filename).read()
+        self.assertTrue(data.startswith('x' * 100 + '\n[output truncated at 100 bytes]'))
+        self.assertEqual(data.count('x'), 100)
+
+    def test_compression(self):
+        filename = os.path.join(self.tmp, 'stdout.txt')
+        settings.SIM_OUTPUT_COMPRESS_MIN_BYTES = 100
+        open(filename, 'w').write('x' * 99)
+        runworker.compress_output(filename)
+        self.assertEqual(os.listdir(self.tmp), ['stdout.txt'])
+        open(filename, 'w').write('x' * 100)
+        runworker.compress_output(filename)
+        self.assertEqual(os.listdir(self.tmp), ['stdout.txt.gz'])
+        self.assertEqual(gzip.open(filename + '.gz').read(), 'x' * 100)
+
+        # the compressed output of an earlier batch does not outlive the next one
+        open(filename, 'w').write('batch 2')
+        runworker.clear_output(filename)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+class SimRunStatusJsonTest(TestCase):
+    '''
+    Test the simrun status.json endpoint used by status.html
+    '''
+
+    def setUp(self):
+        User.objects.create_user('corona', password='password')
+        self.client.login(username='corona', password='password')
+        self.simrun = SimRun(owner_username='corona', params=[])
+        self.simrun.save()
+
+    def test_etag(self):
+        url = '/simrun/%d/status.json' % self.simrun.id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['status'], 'Init')
+
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # time estimates are sent along, but do not release a held long-poll
+        self.simrun.started = timezone.now()
+        self.simrun.progress = {'percent': 10.2, 'eta_secs': 100, 'time': time.time()}
+        self.simrun.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(json.loads(response.content)['percent'], 10)
+        self.assertEqual(json.loads(response.content)['eta_secs'], 100)
+        etag = response['ETag']
+        self.simrun.progress = {'percent': 10.8, 'eta_secs': 90, 'time': time.time()}
+        self.simrun.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.simrun.data_folder = 'static/data/corona_run'
+        self.simrun.complete = timezone.now()
+        self.simrun.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['redirect'], '/simrun/%d/' % self.simrun.id)
+
+        # results are reached through the simrun view, which records their use
+        response = self.client.get('/simrun/%d/' % self.simrun.id)
+        self.assertEqual(response['Location'], '/static/data/corona_run/browse.html')
+        self.assertTrue(SimRun.objects.get(id=self.simrun.id).last_access)
+        self.assertTrue(('/simrun/%d/' % self.simrun.id) in self.client.get('/recent').content)
+
+    def test_longpoll(self):
+        url = '/simrun/%d/status.json?wait=1' % self.simrun.id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # held until the status changes or the hold times out
+        longpoll_secs = views.STATUS_LONGPOLL_SECS
+        views.STATUS_LONGPOLL_SECS = 0.5
+        try:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['X-Long-Poll'], 'held')
+
+            # with all long-poll slots taken, requests are answered right away for the client to back off
+            views.STATUS_LONGPOLL_SECS = 60
+            taken = 0
+            while views.longpoll_slots.acquire(False):
+                taken += 1
+            try:
+                started = time.time()
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertTrue(time.time() - started < 1)
+                self.assertEqual(response.status_code, 304)
+                self.assertFalse(response.has_header('X-Long-Poll'))
+            finally:
+                for i in range(taken):
+                    views.longpoll_slots.release()
+        finally:
+            views.STATUS_LONGPOLL_SECS = longpoll_secs
+
+MCCODE_SIM = '''begin simulation: mcstas
+  Ncount: %(n)d
+  Seed: %(seed)d
+end simulation
+
+begin data
+  type: array_1d(2)
+  component: lmon
+  Ncount: %(n)d
+  filename: lmon.dat
+  statistics: X0=%(x0)g; dX=1;
+  values: %(I)g %(E)g %(N)d
+end data
+'''
+
+LMON_DAT = '''# Ncount: %(n)d
+# type: array_1d(2)
+# statistics: X0=%(x0)g; dX=1;
+# signal: Min=0; Max=0; Mean=0;
+# values: %(I)g %(E)g %(N)d
+# variables: L I I_err N
+1 %(I)g %(E)g %(N)d
+2 0 0 0
+# EndDate: now
+'''
+
+def write_run(d, **values):
+    ''' writes the McCode output folder d, holding mccode.sim and the monitor file lmon.dat, formatted with values '''
+    os.makedirs(d)
+    open(os.path.join(d, 'mccode.sim'), 'w').write(MCCODE_SIM % values)
+    open(os.path.join(d, 'lmon.dat'), 'w').write(LMON_DAT % values)
+    return d
+
+class McMergeTest(TestCase):
+    '''
+    Test merging of McCode output folders of seed-chunks
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_merge_dirs(self):
+        a = write_run(os.path.join(self.tmp, 'a'), n=1000, seed=1, x0=1, I=2.0, E=0.4, N=10)
+        b = write_run(os.path.join(self.tmp, 'b'), n=3000, seed=2, x0=2, I=6.0, E=0.4, N=30)
+        merged = os.path.join(self.tmp, 'merged')
+        merge_dirs([a, b], merged)
+
+        dat = McCodeData(os.path.join(merged, 'lmon.dat'))
+        (I, E, N) = map(float, dat.header('values').split())
+        self.assertAlmostEqual(I, 5.0)
+        self.assertAlmostEqual(E, ((1000 * 0.4) ** 2 + (3000 * 0.4) ** 2) ** 0.5 / 4000)
+        self.assertEqual(N, 40)
+        self.assertEqual(dat.rows(0)[0][3], 40)
+        self.assertEqual(dat.header('Ncount'), '4000')
+        self.assertTrue(dat.header('statistics').startswith('X0=1.9'))
+
+        sim = open(os.path.join(merged, 'mccode.sim')).read()
+        self.assertEqual(sim.count('Ncount: 4000'), 2)
+        self.assertTrue('values: 5 ' in sim)
+
+    def test_sweep_summary(self):
+        simrun = SimRun(params=[['lambda', '1,3'], ['r', '2']], scanpoints=3)
+        points = get_sweep_params(simrun)
+        self.assertEqual(points[1], [['lambda', '2'], ['r', '2']])
+
+        for i in range(3):
+            write_run(os.path.join(self.tmp, str(i)), n=1000, seed=1, x0=1, I=i, E=0.1, N=10)
+        write_sweep_summary(self.tmp, ['lambda'], [[1.0], [2.0], [3.0]], 1000, simrun.params)
+
+        lines = open(os.path.join(self.tmp, 'mccode.dat')).read().splitlines()
+        self.assertTrue('# variables: lambda lmon_I lmon_ERR' in lines)
+        self.assertEqual(lines[-1], '3 2 0.1')
+
+class CacheKeyTest(TestCase):
+    '''
+    Test canonicalization of the SimRun cache key
+    '''
+
+    def test_normalized(self):
+        key = get_cache_key('g', 'i', [['a', '1'], ['b', '.5'], ['c', 'file.dat']], False, 1)
+        self.assertEqual(key, get_cache_key('g', 'i', [['b', '0.5'], ['a', '1.0'], ['c', 'file.dat']], False, 1))
+        self.assertNotEqual(key, get_cache_key('g', 'i', [['a', '1'], ['b', '.5'], ['c', 'file.dat']], True, 1))
+        self.assertEqual(get_cache_key('g', 'i', [['a', '1, 2']], False, 3), get_cache_key('g', 'i', [['a', '1.0,2']], False, 3))
+
+    def test_cache_match(self):
+        cached = SimRun(group_name='g', instr_displayname='i', params=[['a', '1.0']], neutrons=10**7, enable_cachefrom=True,
+                        complete=timezone.now(), instr_hash='1')
+        cached.cache_key = get_simrun_cache_key(cached)
+        cached.save()
+
+        simrun = SimRun(group_name='g', instr_displayname='i', params=[['a', '1']], neutrons=10**6, instr_hash='1')
+        simrun.cache_key = get_simrun_cache_key(simrun)
+        self.assertEqual(get_cache_match(simrun).id, cached.id)
+        simrun.neutrons = 10**8
+        self.assertIsNone(get_cache_match(simrun))
+
+class AdaptiveTest(TestCase):
+    '''
+    Test running adaptive simruns in batches until the target error
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.mcrun = runworker.mcrun
+        runworker.mcrun = self.run_batch
+        self.batches = []
+        self.settings = (getattr(settings, 'ADAPTIVE_FIRST_BATCH_RAYS', None), getattr(settings, 'ADAPTIVE_MAX_GROWTH', None))
+        settings.ADAPTIVE_FIRST_BATCH_RAYS = 1000
+        settings.ADAPTIVE_MAX_GROWTH = 8
+
+    def tearDown(self):
+        runworker.mcrun = self.mcrun
+        (settings.ADAPTIVE_FIRST_BATCH_RAYS, settings.ADAPTIVE_MAX_GROWTH) = self.settings
+        shutil.rmtree(self.tmp)
+
+    def run_batch(self, simrun, neutrons=None, seed=None, outdir=None):
+        ''' stands in for mcrun, giving a relative error of 10/sqrt(rays) '''
+        self.batches.append(neutrons)
+        write_run(os.path.join(self.tmp, outdir), n=neutrons, seed=seed, x0=1, I=1.0, E=10 / neutrons ** 0.5, N=neutrons)
+        simrun.cpu_seconds = 1
+
+    def test_adaptive_batches(self):
+        d = write_run(os.path.join(self.tmp, 'a'), n=1000, seed=1, x0=1, I=2.0, E=0.4, N=10)
+        self.assertAlmostEqual(relative_error(d), 0.2)
+        self.assertAlmostEqual(relative_error(d, 'lmon.dat'), 0.2)
+        self.assertRaises(Exception, relative_error, d, 'nosuchmonitor')
+
+        # 4x the error needs 16x the rays, padded and limited by growth, first batch and cap
+        self.assertEqual(runworker.get_next_batch(1000, 0.2, 0.1, 100, 10**6, 8), 3400)
+        self.assertEqual(runworker.get_next_batch(1000, 0.8, 0.1, 100, 10**6, 8), 8000)
+        self.assertEqual(runworker.get_next_batch(1000, 0.1001, 0.1, 200, 10**6, 8), 200)
+        self.assertEqual(runworker.get_next_batch(1000, 0.2, 0.1, 100, 2000, 8), 1000)
+
+    def test_adaptive_mcrun(self):
+        simrun = SimRun(data_folder=self.tmp, neutrons=10**7, seed=1, target_error=0.01)
+        runworker.adaptive_mcrun(simrun)
+        self.assertEqual(simrun.neutrons, sum(self.batches))
+        self.assertEqual(simrun.cpu_seconds, len(self.batches))
+        self.assertEqual(os.listdir(self.tmp), ['mcstas'])
+        # stops once the target error is reached, each batch at most max growth times the rays before it
+        outdir = os.path.join(self.tmp, 'mcstas')
+        self.assertTrue(relative_error(outdir) <= 0.01)
+        self.assertTrue(10 / sum(self.batches[:-1]) ** 0.5 > 0.01)
+        self.assertEqual(self.batches[:4], [1000, 8000, 72000, 648000])
+        for k in range(1, len(self.batches)):
+            self.assertTrue(self.batches[k] <= 8 * sum(self.batches[:k]))
+
+    def test_adaptive_cap(self):
+        simrun = SimRun(data_folder=self.tmp, neutrons=20000, seed=1, target_error=0.01, target_monitor='lmon.dat')
+        runworker.adaptive_mcrun(simrun)
+        self.assertEqual(self.batches, [1000, 8000, 11000])
+        self.assertEqual(simrun.neutrons, 20000)
+        self.assertTrue(relative_error(os.path.join(self.tmp, 'mcstas'), 'lmon.dat') > 0.01)
+
+class ResultCacheTest(TestCase):
+    '''
+    Test lookup and loading of cached results
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_cached_points(self):
+        single = SimRun(group_name='g', instr_displayname='i', params=[['lambda', '2.0'], ['r', '2']], enable_cachefrom=True,
+                        data_folder=self.tmp, complete=timezone.now(), instr_hash='1')
+        single.cache_key = get_simrun_cache_key(single)
+        single.save()
+        write_run(os.path.join(self.tmp, 'mcstas'), n=1000, seed=1, x0=1, I=1, E=0.1, N=10)
+
+        sweep = SimRun(group_name='g', instr_displayname='i', params=[['lambda', '1,3'], ['r', '2']], scanpoints=3, instr_hash='1')
+        sweep.save()
+        self.assertEqual(find_cached_points(sweep), {1: os.path.join(self.tmp, 'mcstas')})
+
+        # results of another instrument version do not match
+        sweep.instr_hash = '2'
+        self.assertEqual(find_cached_points(sweep), {})
+
+    def test_file_hash(self):
+        f = os.path.join(self.tmp, 'test.instr')
+        open(f, 'w').write('DEFINE INSTRUMENT test()')
+        h = get_file_hash(f)
+        self.assertEqual(get_file_hash(f), h)
+        open(f, 'w').write('DEFINE INSTRUMENT test(lambda=1)')
+        self.assertNotEqual(get_file_hash(f), h)
+
+    def test_link_tree(self):
+        src = write_run(os.path.join(self.tmp, 'src'), n=1000, seed=1, x0=1, I=1, E=0.1, N=10)
+        os.symlink('lmon.dat', os.path.join(src, 'link.dat'))
+        dst = os.path.join(self.tmp, 'dst')
+        link_tree(src, dst)
+        self.assertEqual(os.stat(os.path.join(dst, 'lmon.dat')).st_ino, os.stat(os.path.join(src, 'lmon.dat')).st_ino)
+        self.assertEqual(os.readlink(os.path.join(dst, 'link.dat')), 'lmon.dat')
+
+    def test_refinement_base(self):
+        for n in [10**5, 10**6]:
+            cached = SimRun(group_name='g', instr_displayname='i', params=[['a', '1']], neutrons=n, enable_cachefrom=True,
+                            complete=timezone.now(), instr_hash='1', data_folder=self.tmp)
+            cached.cache_key = get_simrun_cache_key(cached)
+            cached.save()
+        write_run(os.path.join(self.tmp, 'mcstas'), n=10**6, seed=1, x0=1, I=1, E=0.1, N=10)
+
+        simrun = SimRun(group_name='g', instr_displayname='i', params=[['a', '1']], neutrons=10**7, instr_hash='1')
+        simrun.cache_key = get_simrun_cache_key(simrun)
+        self.assertEqual(get_refinement_base(simrun).neutrons, 10**6)
+        simrun.neutrons = 10**5
+        self.assertIsNone(get_refinement_base(simrun))
+
+class InstrumentPostTest(TestCase):
+    '''
+    Test completing cache hits in the startsim view
+    '''
+
+    def setUp(self):
+        User.objects.create_user('corona', password='password')
+        self.client.login(username='corona', password='password')
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.sim_dir = resultcache.SIM_DIR
+        resultcache.SIM_DIR = os.path.join(self.tmp, 'sim')
+        os.makedirs(os.path.join(resultcache.SIM_DIR, 'g'))
+        open(os.path.join(resultcache.SIM_DIR, 'g', 'test.instr'), 'w').write('DEFINE INSTRUMENT test(a=1)')
+
+        self.cached = SimRun(owner_username='corona', group_name='g', instr_displayname='test', params=[['a', '1']], enable_cachefrom=True,
+                             complete=timezone.now(), instr_hash=resultcache.get_instr_hash('g', 'test'),
+                             data_folder=os.path.join(get_data_basedir(), 'cached'), plot_files_str='[]', plot_files_log_str='[]', data_files_str='[]')
+        self.cached.cache_key = get_simrun_cache_key(self.cached)
+        self.cached.save()
+        write_run(os.path.join(self.cached.data_folder, 'mcstas'), n=10**6, seed=1, x0=1, I=1, E=0.1, N=10)
+
+    def tearDown(self):
+        resultcache.SIM_DIR = self.sim_dir
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def post(self):
+        self.response = self.client.post('/startsim/', {'group_name': 'g', 'instr_displayname': 'test', 'neutrons': '1e5', 'scanpoints': '1', 'seed': '0',
+                                        'params_jsonified': json.dumps([['a', '1']]), 'a': '1'})
+        return SimRun.objects.latest('id')
+
+    def test_cache_hit(self):
+        simrun = self.post()
+        self.assertEqual(simrun.cache_source_id, self.cached.id)
+        self.assertTrue(simrun.complete)
+        self.assertEqual(self.response['Location'], '/simrun/%d' % simrun.id)
+        self.assertTrue(os.path.isfile(os.path.join(simrun.data_folder, 'mcstas', 'mccode.sim')))
+        self.assertTrue(os.path.isfile(os.path.join(simrun.data_folder, 'browse.html')))
+
+        # a resubmit within the same second gets its own data folder
+        again = self.post()
+        self.assertNotEqual(again.data_folder, simrun.data_folder)
+        self.assertTrue(again.complete)
+        self.assertTrue(os.path.isfile(os.path.join(simrun.data_folder, 'browse.html')))
+
+    def test_load_error(self):
+        self.cached.plot_files_str = 'broken'
+        self.cached.save()
+        simrun = self.post()
+
+        # the simrun is queued for the worker and only the folder made for it is removed
+        self.assertIsNone(simrun.started)
+        self.assertIsNone(simrun.data_folder)
+        self.assertIsNone(simrun.cache_source)
+        self.assertFalse(os.path.exists(get_simrun_folder(simrun)))
+        self.assertTrue(os.path.isfile(os.path.join(self.cached.data_folder, 'mcstas', 'mccode.sim')))
+
+class RetentionTest(TestCase):
+    '''
+    Test eviction order and hardlink-aware accounting of simrun data folders
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_simrun(self, name, days, **fields):
+        folder = os.path.join(self.tmp, name)
+        os.mkdir(folder)
+        open(os.path.join(folder, 'mccode.sim'), 'w').write('x' * 10000)
+        simrun = SimRun(data_folder=folder, complete=timezone.now() - timedelta(days=days), enable_cachefrom=True, **fields)
+        simrun.save()
+        return simrun
+
+    def test_eviction(self):
+        popular = self.make_simrun('popular', 20, cache_hits=15)
+        old = self.make_simrun('old', 10)
+        self.make_simrun('recent', 1)
+        self.make_simrun('pinned', 30, pinned=True)
+        self.assertEqual([s.id for s in get_eviction_candidates(7, 1)], [old.id, popular.id])
+
+        # files shared with a cached copy are not reclaimed
+        link_tree(old.data_folder, os.path.join(self.tmp, 'copy'))
+        self.assertEqual(get_tree_bytes(old.data_folder, unique=True), 0)
+        self.assertEqual(get_tree_bytes(self.tmp), 4 * get_tree_bytes(popular.data_folder))
+        self.assertEqual(evict(old), 0)
+        self.assertIsNone(evict(old))
+
+        old = SimRun.objects.get(id=old.id)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'old')))
+        self.assertIsNone(old.data_folder)
+        self.assertFalse(old.enable_cachefrom)
+        self.assertTrue(old.evicted)
+        self.assertTrue(evict(popular) > 0)
+
+    def test_budget(self):
+        older = self.make_simrun('older', 20)
+        old = self.make_simrun('old', 10)
+        link_tree(old.data_folder, os.path.join(self.tmp, 'copy'))
+        copy = SimRun(data_folder=os.path.join(self.tmp, 'copy'), complete=timezone.now(), cache_source=old)
+        copy.save()
+
+        # disk usage is recorded pr. data folder, files linked from a cache source counted once
+        size = get_tree_bytes(old.data_folder)
+        self.assertEqual(get_used_bytes(), 2 * size)
+        self.assertEqual(SimRun.objects.get(id=copy.id).data_bytes, 0)
+        self.assertEqual(enforce_budget(2 * size), (0, 0, 2 * size))
+        self.assertTrue(os.path.isdir(older.data_folder))
+
+        self.assertEqual(enforce_budget(size), (1, size, 2 * size))
+        self.assertFalse(os.path.exists(older.data_folder))
+
+        # the files of an evicted cache source left in its copy are counted with the copy
+        self.assertEqual(enforce_budget(0), (1, 0, size))
+        self.assertEqual(SimRun.objects.get(id=copy.id).data_bytes, size)
+        self.assertEqual(get_used_bytes(), size)
+
+class DataDirTest(TestCase):
+    '''
+    Test moving flat-layout data folders into shards
+    '''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        os.makedirs(os.path.join(get_data_basedir(), 'sim_run'))
+        os.makedirs(os.path.join('sim', 'datafiles'))
+        open(os.path.join('sim', 'datafiles', 'a.dat'), 'w').write('a')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_shard_folder(self):
+        old = os.path.join(get_data_basedir(), 'sim_run')
+        os.symlink(os.path.relpath('sim/datafiles/a.dat', old), os.path.join(old, 'a.dat'))
+        os.symlink('a.dat', os.path.join(old, 'b.dat'))
+        simrun = SimRun(data_folder=old, complete=timezone.now())
+        simrun.save()
+        SimRun(data_folder=os.path.join(old, 'subruns', '0'), parent=simrun).save()
+
+        new = shard_folder(simrun)
+        self.assertEqual(new, get_data_folder('sim_run'))
+        self.assertEqual(len(os.path.relpath(new, get_data_basedir()).split(os.sep)), 3)
+        self.assertEqual(open(os.path.join(old, 'a.dat')).read(), 'a')
+        self.assertEqual(open(os.path.join(new, 'a.dat')).read(), 'a')
+        self.assertEqual(os.readlink(os.path.join(new, 'b.dat')), 'a.dat')
+        self.assertEqual(SimRun.objects.get(id=simrun.id).data_folder, new)
+        self.assertEqual(simrun.subruns.get().data_folder, os.path.join(new, 'subruns', '0'))
+
+        # cached copies of legacy folders get working links too
+        link_tree(new, os.path.join(get_data_basedir(), 'copy'))
+        self.assertEqual(open(os.path.join(get_data_basedir(), 'copy', 'a.dat')).read(), 'a')
+
+class ArtifactTest(TestCase):
+    '''
+    Test hardlinking instrument files from the artifact store
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.artifact_dir = getattr(settings, 'ARTIFACT_DIR', None)
+        settings.ARTIFACT_DIR = os.path.join(self.tmp, 'artifacts')
+
+    def tearDown(self):
+        settings.ARTIFACT_DIR = self.artifact_dir
+        shutil.rmtree(self.tmp)
+
+    def test_link_artifact(self):
+        src = os.path.join(self.tmp, 'test.out')
+        open(src, 'w').write('binary')
+        os.chmod(src, 0o755)
+        for run in ['a', 'b']:
+            os.mkdir(os.path.join(self.tmp, run))
+            self.assertTrue(link_artifact(src, os.path.join(self.tmp, run, 'test.out')))
+        (a, b) = [os.stat(os.path.join(self.tmp, run, 'test.out')) for run in ['a', 'b']]
+        self.assertEqual(a.st_ino, b.st_ino)
+        self.assertTrue(os.access(os.path.join(self.tmp, 'a', 'test.out'), os.X_OK))
+        self.assertFalse(a.st_mode & 0o222)
+        self.assertFalse(link_artifact(os.path.join(self.tmp, 'test.c'), os.path.join(self.tmp, 'a', 'test.c')))
+
+        # a new version is stored separately
+        os.remove(src)
+        open(src, 'w').write('binary v2')
+        os.mkdir(os.path.join(self.tmp, 'c'))
+        link_artifact(src, os.path.join(self.tmp, 'c', 'test.out'))
+        self.assertEqual(open(os.path.join(self.tmp, 'a', 'test.out')).read(), 'binary')
+        self.assertEqual(open(os.path.join(self.tmp, 'c', 'test.out')).read(), 'binary v2')
+
+class ArchiveTest(TestCase):
+    '''
+    Test streaming and caching of download archives
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_stream_tarball(self):
+        folder = os.path.join(self.tmp, 'sim_run')
+        os.makedirs(os.path.join(folder, 'mcstas'))
+        for f in ['test.instr', 'test.out', 'test.c', os.path.join('mcstas', 'mccode.sim')]:
+            open(os.path.join(folder, f), 'w').write(f)
+
+        data = b''.join(stream_tarball(folder, chunk_size=1))
+        self.assertEqual(open(os.path.join(folder, 'simrun.tar.gz'), 'rb').read(), data)
+        self.assertEqual(os.listdir(folder).count('simrun.tar.gz'), 1)
+        tar = tarfile.open(fileobj=io.BytesIO(data))
+        self.assertEqual(tar.getnames(), ['sim_run/test.instr', 'sim_run/mcstas/mccode.sim'])
+
+        # an aborted download leaves nothing behind
+        os.remove(os.path.join(folder, 'simrun.tar.gz'))
+        gen = stream_tarball(folder, chunk_size=1)
+        next(gen)
+        gen.close()
+        self.assertEqual(sorted(os.listdir(folder)), ['mcstas', 'test.c', 'test.instr', 'test.out'])
+
+    def test_sweep_zip(self):
+        for i in range(12):
+            os.makedirs(os.path.join(self.tmp, 'mcstas', str(i)))
+            open(os.path.join(self.tmp, 'mcstas', str(i), 'PSD.dat'), 'w').write(str(i))
+        zippath = get_sweep_zip(self.tmp, 'PSD.dat', 12)
+        self.assertEqual(zippath, os.path.join(self.tmp, 'PSD.zip'))
+        names = zipfile.ZipFile(zippath).namelist()
+        self.assertEqual(names, ['mcstas/%d/PSD.dat' % i for i in range(12)])
+
+        # cached
+        mtime = os.stat(zippath).st_mtime
+        self.assertEqual(get_sweep_zip(self.tmp, 'PSD.dat', 12), zippath)
+        self.assertEqual(os.stat(zippath).st_mtime, mtime)
+
+class SplitSweepTest(TestCase):
+    '''
+    Test splitting of scan sweeps into a subrun pr. scan point, and their assembly
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.simrun = SimRun(owner_username='corona', group_name='g', instr_displayname='test', params=[['lambda', '1,3'], ['r', '2']],
+                             scanpoints=3, neutrons=1000, started=timezone.now(), data_folder=os.path.join(self.tmp, 'sweep'), instr_hash='1')
+        self.simrun.cache_key = get_simrun_cache_key(self.simrun)
+        self.simrun.save()
+        os.mkdir(self.simrun.data_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_split_and_assemble(self):
+        # scan point 1 is in the cache
+        single = SimRun(group_name='g', instr_displayname='test', params=[['lambda', '2'], ['r', '2']], neutrons=1000, instr_hash='1',
+                        enable_cachefrom=True, complete=timezone.now(), data_folder=os.path.join(self.tmp, 'single'))
+        single.cache_key = get_simrun_cache_key(single)
+        single.save()
+        write_run(os.path.join(single.data_folder, 'mcstas'), n=1000, seed=1, x0=1, I=20, E=0.1, N=10)
+
+        runworker.split_sweep(self.simrun, find_cached_points(self.simrun))
+        subruns = list(self.simrun.subruns.order_by('subrun_index'))
+        self.assertEqual([s.subrun_index for s in subruns], [0, 2])
+        self.assertEqual([s.params for s in subruns], [[['lambda', '1'], ['r', '2']], [['lambda', '3'], ['r', '2']]])
+        self.assertEqual(self.simrun.subruns_pending, 2)
+
+        # the subrun finishing last assembles the sweep
+        for s in subruns:
+            s.data_folder = os.path.join(self.simrun.data_folder, 'subruns', str(s.subrun_index))
+            write_run(os.path.join(s.data_folder, 'mcstas'), n=1000, seed=1, x0=1, I=10 * (s.subrun_index + 1), E=0.1, N=10)
+            s.complete = timezone.now()
+            s.save()
+            runworker.complete_subrun(s)
+
+        simrun = SimRun.objects.get(id=self.simrun.id)
+        self.assertTrue(simrun.complete)
+        self.assertIsNone(simrun.failed)
+        outdir = os.path.join(simrun.data_folder, 'mcstas')
+        lines = open(os.path.join(outdir, 'mccode.dat')).read().splitlines()
+        self.assertEqual(lines[-3:], ['1 10 0.1', '2 20 0.1', '3 30 0.1'])
+        self.assertTrue(os.path.isfile(os.path.join(outdir, '2', 'lmon.dat')))
+        self.assertTrue(os.path.isfile(os.path.join(simrun.data_folder, 'browse.html')))
+
+        # each scan point is indexed as the equivalent single-point simrun
+        points = simrun.sweep_points.order_by('index')
+        self.assertEqual([p.index for p in points], [0, 1, 2])
+        self.assertEqual(points[1].cache_key, single.cache_key)
+
+class SingleFlightTest(TestCase):
+    '''
+    Test deduplication of identical SimRun objects in flight
+    '''
+
+    def identical(self, **fields):
+        simrun = SimRun(owner_username='corona', group_name='g', instr_displayname='i', params=[['a', '1']], instr_hash='1', **fields)
+        simrun.cache_key = get_simrun_cache_key(simrun)
+        simrun.save()
+        return simrun
+
+    def test_follow_and_requeue(self):
+        leader = self.identical(started=timezone.now())
+        follower = self.identical(started=timezone.now())
+        self.assertEqual(find_leader(follower).id, leader.id)
+        # a leader never follows a later simrun
+        self.assertIsNone(find_leader(leader))
+
+        follow(follower, leader, 'web')
+        self.assertEqual(SimRun.objects.get(id=follower.id).leader_id, leader.id)
+
+        # a leader cancelled before start leaves the follower orphaned until the worker requeues it
+        leader.failed = timezone.now()
+        leader.save()
+        self.assertEqual(resolve_orphans('worker'), 1)
+        follower = SimRun.objects.get(id=follower.id)
+        self.assertIsNone(follower.started)
+        self.assertIsNone(follower.leader)
+
+class SplitSimRunTest(TestCase):
+    '''
+    Test splitting of large SimRun objects into seed-chunk subruns
+    '''
+
+    def setUp(self):
+        self.simrun = SimRun(owner_username='corona', params=[], neutrons=10**10 + 1, seed=7, started=timezone.now())
+        self.simrun.save()
+
+    def test_split_and_count_down(self):
+        chunks = runworker.get_chunk_count(self.simrun)
+        self.assertEqual(chunks, 16)
+        runworker.split_simrun(self.simrun, chunks)
+
+        subruns = list(self.simrun.subruns.order_by('subrun_index'))
+        self.assertEqual(sum(s.neutrons for s in subruns), 10**10 + 1)
+        self.assertEqual(len(set(s.seed for s in subruns)), chunks)
+
+        subruns[0].complete = timezone.now()
+        subruns[0].save()
+        runworker.complete_subrun(subruns[0])
+        parent = SimRun.objects.get(id=self.simrun.id)
+        self.assertEqual(parent.subruns_pending, chunks - 1)
+        self.assertEqual(parent.status(), 'Running')
+
+        runworker.fail_split_simrun(subruns[1], 'Instrument run failure')
+        parent = SimRun.objects.get(id=self.simrun.id)
+        self.assertEqual(parent.status(), 'Error')
+        self.assertEqual(SimRun.objects.filter(parent=parent, cancelled__isnull=False).count(), chunks - 1)
@@ -31,10 +31,90 @@ AUTHENTICATION_BACKENDS = (
     'django.contrib.auth.backends.ModelBackend', # uncomment this line to enable local sign-on (django-db)
 )
 
-# number of MPI processes pr worker process
+# max number of MPI processes pr simulation run while other runs are queued, the actual number is sized from the ray count and free cores
 MPI_PR_WORKER=4
 MAX_THREADS=8
 
+# runworker wakeup sockets (instrument_post signals local workers), and the fallback poll interval in secs
+WORKER_WAKEUP_DIR = '/srv/mcweb/McWeb/mcsimrunner/wakeup'
+WORKER_POLL_SECS = 30
+
+# runworker scheduling policy, 'fifo' or 'fairshare'
+SCHEDULER_POLICY = 'fairshare'
+# fairshare: max running simruns pr. user (0 means no limit)
+SCHEDULER_MAX_RUNS_PR_USER = 2
+# fairshare: usernames with a larger share of the cpu (default weight is 1)
+SCHEDULER_USER_WEIGHTS = {}
+# fairshare: priority classes, e.g. teacher/demo accounts, higher classes are always served first (default class is 0)
+SCHEDULER_USER_PRIORITIES = {}
+# fairshare: hours of consumed cpu-seconds taken into account
+SCHEDULER_USAGE_HOURS = 24
+
+# runworker lanes: simruns expected to take at most LANE_SHORT_MAX_CPU_SECS go in the short lane,
+# the rest in the long lane. Each lane has a number of the MAX_THREADS slots reserved.
+LANE_SHORT_MAX_CPU_SECS = 60
+LANE_SHORT_RESERVED = 2
+LANE_LONG_RESERVED = 1
+# rays pr. cpu-second assumed for instruments without completed simruns
+LANE_DEFAULT_RAY_RATE = 1e6
+
+# cores available to runworker for MPI ranks (None means all cores), and the min number of rays pr. rank
+WORKER_CORES = None
+MPI_MIN_RAYS_PR_RANK = 1000000
+# max number of MPI processes of a simulation run started with no other runs queued (0 means all free cores)
+MPI_MAX_RANKS_PR_RUN = 0
+
+# single-rank runs of at most this many rays execute the compiled instrument directly, bypassing mcrun (0 disables)
+DIRECT_RUN_MAX_RAYS = 1000000
+
+# limits for mcrun: wall-clock secs pr. run, and cpu secs and memory pr. process (each MPI rank) (0 means no limit).
+# The memory limit is an address space limit of each process, which also applies to mcrun, mpirun and its daemons,
+# whose address space may be large, so only set it well above what they need.
+SIM_MAX_WALLTIME_SECS = 6*3600
+SIM_MAX_CPU_SECS = 0
+SIM_MAX_MEMORY_MB = 0
+
+# mcrun stdout/stderr files are truncated at SIM_OUTPUT_MAX_BYTES, and gzipped when larger than
+# SIM_OUTPUT_COMPRESS_MIN_BYTES once the run is done (0 disables either)
+SIM_OUTPUT_MAX_BYTES = 50*1024*1024
+SIM_OUTPUT_COMPRESS_MIN_BYTES = 1024*1024
+
+# max secs a simrun status.json long-poll request is held, and the secs between status reads meanwhile. A held request
+# occupies a uwsgi thread, so each web server process holds at most STATUS_LONGPOLL_MAX_HELD at once (0 disables
+# long-polling), and answers further requests right away; status pages then poll with back-off.
+STATUS_LONGPOLL_SECS = 10
+STATUS_LONGPOLL_INTERVAL = 1
+STATUS_LONGPOLL_MAX_HELD = 4
+
+# single-point simruns of at least SPLIT_MIN_RAYS rays (0 disables) are split into subruns of about SPLIT_CHUNK_RAYS
+# rays with distinct seeds, at most SPLIT_MAX_CHUNKS, which any worker may run; the monitor output is merged afterwards
+SPLIT_MIN_RAYS = 1000000000
+SPLIT_CHUNK_RAYS = 250000000
+SPLIT_MAX_CHUNKS = 16
+# scan sweeps are split into a subrun pr. scan point, which run in parallel and are assembled into the mcrun -N
+# output afterwards. Scan points found in the result cache are loaded from it regardless.
+SPLIT_SWEEPS = True
+
+# simruns given a target relative error run batches of rays, starting at ADAPTIVE_FIRST_BATCH_RAYS, each at most
+# ADAPTIVE_MAX_GROWTH times the rays run so far, until the target is reached or the requested rays have run
+ADAPTIVE_FIRST_BATCH_RAYS = 100000
+ADAPTIVE_MAX_GROWTH = 8
+
+# the static/data folders of finished simruns are evicted, least recently used first, while the data dir uses more than
+# RETENTION_MAX_BYTES (0 disables). Each cache hit of a simrun counts as RETENTION_HIT_DAYS days of recency, simruns used
+# within RETENTION_KEEP_DAYS and pinned simruns are kept. Workers check the budget every RETENTION_INTERVAL_SECS (0 disables).
+RETENTION_MAX_BYTES = 0
+RETENTION_KEEP_DAYS = 7
+RETENTION_HIT_DAYS = 1
+RETENTION_INTERVAL_SECS = 3600
+
+# simrun data folders are sharded into this many levels of subdirs of static/data, see simrunner.datadirs
+DATA_SHARD_LEVELS = 2
+
+# instrument .instr, .c and .out files are stored here by content hash, and hardlinked into simrun data folders,
+# so it should be on the same filesystem as static/data
+ARTIFACT_DIR = '/srv/mcweb/McWeb/mcsimrunner/artifacts'
+
 MCRUN = 'mcrun.pl'
 MXRUN = 'mxrun.pl'
 